@@ -0,0 +1,198 @@
+# Historical replay of the models over a time range. Timestamps are split
+# into chunks that share one speed pull, the chunks are estimated in a
+# process pool (each worker holds its own ModelZoo) and the predictions are
+# written incrementally to a parquet file, one row group per chunk, or to an
+# Arrow IPC stream (.arrow), one record batch per chunk.
+# Usage: python main.py --backtest START END [--step 5] [--chunk 6] [-w 4]
+#        [--output backtest.parquet]
+# Functions:
+# - backtest_timestamps: Returns the replayed timestamps
+# - split_chunks: Splits timestamps into chunks
+# - estimate_chunk: Estimates the timestamps of one chunk
+# - run_backtest: Runs the replay and writes the predictions
+
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from getrawdata import agg_speed_5m, get_bb_base_status_df, get_speed_data
+from processdata import LAGS, LANE_CONFIGURATIONS
+from serialize import write_arrow_stream
+
+
+# Oldest speeds needed for one timestamp: its 5 minute interval and the lags
+LAG_SPAN = timedelta(minutes=max(LAGS))
+
+_worker = {'modelzoo': None}
+
+
+def backtest_timestamps(start, end, step=5):
+    """
+    Returns the replayed timestamps
+
+    Args:
+        start (str/datetime): first timestamp. Naive timestamps are UTC.
+        end (str/datetime): last timestamp (included)
+        step (int): step [min]
+
+    Returns:
+        pd.DatetimeIndex: UTC timestamps from start to end
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    start = start.tz_localize('UTC') if start.tzinfo is None else start.tz_convert('UTC')
+    end = end.tz_localize('UTC') if end.tzinfo is None else end.tz_convert('UTC')
+    return pd.date_range(start, end, freq=f'{step}min')
+
+
+def split_chunks(timestamps, chunk=6):
+    """
+    Splits timestamps into chunks of at most chunk timestamps. Each chunk is
+    estimated from one speed pull, as of its last timestamp, so the speed
+    window of the endpoint has to cover the chunk and 30 minutes of lags.
+
+    Returns:
+        list: list of pd.DatetimeIndex
+    """
+    return [timestamps[i:i + chunk] for i in range(0, len(timestamps), chunk)]
+
+
+def _init_worker(speed_endpoint, token):
+    # Imported here, so that the pool workers load their own models
+    from modelzoo import ModelZoo
+    _worker['modelzoo'] = ModelZoo(speed_endpoint=speed_endpoint, token=token)
+
+
+def estimate_chunk(chunk, directions, forecast_horizon='all', modelzoo=None):
+    """
+    Estimates the timestamps of one chunk for all lane configurations. The
+    speeds of each direction are requested once, as of the last timestamp,
+    and each timestamp only sees the records up to itself, as estimate_now
+    would have at that time. The features of all timestamps are estimated
+    in one batch.
+
+    Args:
+        chunk (pd.DatetimeIndex): UTC timestamps
+        directions (list): traffic directions (East/West)
+        forecast_horizon: forecast horizon[s] in minutes. Could be an int,
+                          a list of integers or a string 'all'
+        modelzoo (ModelZoo, optional): models. The worker's ModelZoo if None.
+
+    Returns:
+        pd.DataFrame: estimates, as returned by ModelZoo.estimate, with the
+                      additional first columns 'direction' and 'asof' (the
+                      replayed timestamp). Timestamps without speeds for
+                      their lags have no rows.
+    """
+    if modelzoo is None:
+        modelzoo = _worker['modelzoo']
+    lane_data = get_bb_base_status_df()
+
+    results = []
+    for direction in directions:
+        raw = get_speed_data(
+            modelzoo.tmcs_all_dict[direction],
+            speed_endpoint=modelzoo.speed_endpoint,
+            asof=chunk[-1].to_pydatetime(),
+            token=modelzoo.token)
+        tstamps = pd.to_datetime(raw['measurement_tstamp'], utc=True)
+
+        ml_data, positions = [], []
+        for i, timestamp in enumerate(chunk):
+            since = timestamp.floor('5min') - LAG_SPAN
+            rows = raw[((tstamps >= since) & (tstamps <= timestamp)).to_numpy()]
+            if len(rows) == 0:
+                continue
+            data = modelzoo.build_ml_data(direction, agg_speed_5m(rows),
+                                          lane_data, expand=False)
+            if len(data) > 0:
+                ml_data.append(data)
+                positions.append(np.full(len(data), i))
+
+        if len(ml_data) == 0:
+            continue
+        ml_data = pd.concat(ml_data, ignore_index=True)
+        res_df = modelzoo.estimate(ml_data, direction, forecast_horizon,
+                                   configurations=LANE_CONFIGURATIONS)
+        # Rows are replicated configuration major (see expand_configurations)
+        positions = np.tile(np.concatenate(positions), len(LANE_CONFIGURATIONS))
+        res_df.insert(0, 'asof', chunk[positions])
+        res_df.insert(0, 'direction', direction)
+        results.append(res_df)
+
+    if len(results) == 0:
+        return pd.DataFrame()
+    return pd.concat(results, ignore_index=True)
+
+
+def _estimate_chunk(args):
+    return estimate_chunk(*args)
+
+
+def run_backtest(timestamps, output, directions=('East', 'West'),
+                 forecast_horizon='all',
+                 speed_endpoint='https://baybridge.ritis.org/speed/recent/',
+                 token=None, chunk=6, workers=1):
+    """
+    Runs the models over the timestamps and writes the predictions to a
+    parquet file. Chunks are estimated in a process pool and written in
+    order, as they complete, one row group per chunk.
+
+    Args:
+        timestamps (pd.DatetimeIndex): UTC timestamps, see backtest_timestamps
+        output (str): parquet file, or Arrow IPC stream if it ends with
+                      .arrow (fixed schema, see serialize.arrow_schema)
+        directions (list): traffic directions (East/West)
+        forecast_horizon: forecast horizon[s] in minutes
+        speed_endpoint (str): speed endpoint
+        token (str): endpoints token
+        chunk (int): number of timestamps sharing one speed pull
+        workers (int): number of worker processes. Each worker loads its own
+                       ModelZoo. With 1 worker chunks run in this process.
+
+    Returns:
+        dict: number of timestamps, chunks, estimated timestamps and rows
+    """
+    chunks = split_chunks(timestamps, chunk)
+    tasks = [(x, list(directions), forecast_horizon) for x in chunks]
+
+    def written(results):
+        stats = {'timestamps': len(timestamps), 'chunks': len(chunks),
+                 'estimated': 0, 'rows': 0}
+
+        def counted():
+            for res_df in results:
+                if len(res_df) == 0:
+                    continue
+                stats['estimated'] += res_df['asof'].nunique()
+                stats['rows'] += len(res_df)
+                yield res_df
+
+        if output.endswith('.arrow'):
+            write_arrow_stream(output, counted())
+            return stats
+
+        writer = None
+        try:
+            for res_df in counted():
+                # Categories differ between directions
+                res_df['tmc_code'] = res_df['tmc_code'].astype(str)
+                table = pa.Table.from_pandas(res_df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema)
+                writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        return stats
+
+    if workers <= 1:
+        _init_worker(speed_endpoint, token)
+        return written(_estimate_chunk(task) for task in tasks)
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(speed_endpoint, token)) as executor:
+        return written(executor.map(_estimate_chunk, tasks))
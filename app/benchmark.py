@@ -0,0 +1,618 @@
+# Benchmarks of the data processing and prediction stages, run fully offline.
+# The stage suite replays recorded speed and status responses
+# (benchmarks/fixtures/) and synthetic payloads with 10x/100x tmcs and longer
+# windows, served by the local stub (stubserver.py), through each stage. The
+# time and peak memory of every stage are compared with a stored baseline
+# (benchmarks/baseline.json). Named benchmarks compare implementations.
+# Usage: python benchmark.py [--direction East] [--update-baseline]
+#        python benchmark.py --record -t TOKEN (records the live responses)
+#        python benchmark.py BENCHMARK [BENCHMARK ...] (e.g. output_formats)
+# Functions:
+# - synthetic_speeds: Produces speeds, 5 minute or 1 minute records
+# - synthetic_payload: Produces a speed endpoint csv response
+# - status_payload: Produces a status endpoint json response
+# - synthetic_target: Produces a target tmcs dataframe
+# - timeit: Returns the best run time of a function
+# - measure: Returns the best time and the peak memory of a function
+# - record_fixtures: Saves live speed and status responses as fixtures
+# - run_suite: Runs the stage benchmarks
+# - compare: Compares results with the baseline
+# - missing_cases: Lists the cases without a baseline
+# - bench_prepare_ml_data: prepare_ml_data scaling with tmc count and window
+# - bench_generate_queue_data: generate_queue_data on multi-day histories
+# - bench_targeted_features: features for the latest timestamp vs whole window
+# - bench_parse_speed_data: typed read_csv vs split/astype of a speed response
+# - bench_configurations: all lane configurations vs a single configuration
+# - bench_serialization: json/csv rendering of estimates
+# - bench_output_formats: encode/decode time and size of json, csv and arrow
+# - bench_startup: model loading from the pickles vs from a model bundle
+# - bench_memory: peak RSS of the features of a long window, float64 vs float32
+
+import argparse
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from datetime import datetime, timezone
+
+from getrawdata import (SPEED_COLUMNS, agg_speed_5m, get_bb_base_status_df,
+                        get_bb_current_status_df, get_speed_data, http_get,
+                        parse_lane_status, parse_speed_data, read_all_tmcs,
+                        read_target_tmcs)
+from processdata import (LANE_CONFIGURATIONS, expand_configurations,
+                         generate_queue_data, iter_queue_data, prepare_ml_data)
+from serialize import render_csv, render_json_body
+from stubserver import StubServer
+
+
+ASOF = datetime(2022, 10, 5, 17, 30, tzinfo=timezone.utc)
+BENCH_PATH = './benchmarks/'
+FIXTURE_PATH = os.path.join(BENCH_PATH, 'fixtures')
+BASELINE_FILE = os.path.join(BENCH_PATH, 'baseline.json')
+SCALES = (1, 10, 100)
+WINDOWS = (60, 240)
+# Allowed slowdown and memory growth over the baseline
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.2
+
+
+def synthetic_speeds(n_tmcs, window, asof=ASOF, seed=0, tmcs=None, freq=5):
+    """
+    Produces speeds, as returned by agg_speed_5m (freq=5), or one minute
+    records, as returned by get_speed_data (freq=1)
+    Args:
+        n_tmcs (int): number of tmcs
+        window (int): length of the speed window [min]
+        asof (datetime): last timestamp
+        seed (int): random seed
+        tmcs (list, optional): tmc codes. Generated if None.
+        freq (int): minutes between records
+    Returns:
+        pd.DataFrame: DataFrame with speeds
+    """
+    rng = np.random.default_rng(seed)
+    if tmcs is None:
+        tmcs = [f'110+{x:05d}' for x in range(n_tmcs)]
+    n_tmcs = len(tmcs)
+    times = pd.date_range(end=asof, periods=window // freq, freq=f'{freq}min')
+    tmc_code = np.repeat(tmcs, len(times))
+    tstamp = np.tile(times, n_tmcs)
+    reference = np.repeat(50 + np.arange(n_tmcs) % 7, len(times)).astype(float)
+    speed = reference * rng.uniform(0.3, 1.2, len(tmc_code))
+    return pd.DataFrame({
+        'tmc_code': tmc_code,
+        'measurement_tstamp': tstamp,
+        'speed': speed,
+        'average_speed': reference * rng.uniform(0.9, 1.1, len(tmc_code)),
+        'reference_speed': reference,
+        'travel_time_minutes': 0.5 * reference / speed,
+    })
+
+
+def synthetic_payload(tmcs, window, asof=ASOF, seed=0):
+    """
+    Produces a speed endpoint csv response: one record per tmc and minute
+
+    Args:
+        tmcs (list): tmc codes
+        window (int): length of the window [min]
+        asof (datetime): last timestamp
+        seed (int): random seed
+
+    Returns:
+        bytes: csv response
+    """
+    speeds = synthetic_speeds(0, window, asof.replace(tzinfo=None), seed, tmcs, freq=1)
+    for c in ['speed', 'average_speed', 'reference_speed']:
+        speeds[c] = np.maximum(1, speeds[c].round()).astype(int)
+    speeds['travel_time_minutes'] = (0.5 * speeds.reference_speed / speeds.speed).round(4)
+    speeds['measurement_tstamp'] = speeds.measurement_tstamp.dt.strftime('%Y-%m-%d %H:%M:%S')
+    return speeds[SPEED_COLUMNS].to_csv(index=False).encode()
+
+
+def status_payload(west=2):
+    """
+    Produces a status endpoint json response with west lanes L1.. westbound
+    and the other lanes eastbound
+    """
+    lanes = {}
+    for i in range(1, 6):
+        default = 'W' if i <= 3 else 'E'
+        direction = 'W' if i <= west else 'E'
+        lanes[f'L{i}'] = {'isClosed': False,
+                          'isContraflow': direction != default,
+                          'defaultDirection': default,
+                          'direction': direction}
+    return json.dumps({'status': {'lanes': lanes}}).encode()
+
+
+def synthetic_target(speeds, share=0.25):
+    """
+    Produces a target tmcs dataframe from a share of tmcs in speeds
+    """
+    tmcs = sorted(speeds.tmc_code.unique())
+    tmcs = tmcs[:max(1, int(len(tmcs) * share))]
+    length = np.full(len(tmcs), 0.3)
+    return pd.DataFrame({
+        'tmc_code': tmcs,
+        'dist': np.cumsum(length),
+        'length': length,
+    })
+
+
+def timeit(func, repeat=3):
+    """
+    Returns the best run time of func [s]
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def measure(func, repeat=3):
+    """
+    Returns the best time [ms] of func over repeat runs and the peak memory
+    [KiB] traced (tracemalloc) during an additional run
+    """
+    best = timeit(func, repeat)
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'time_ms': round(best * 1000, 3), 'peak_kib': round(peak / 1024, 1)}
+
+
+def record_fixtures(token, direction='East',
+                    speed_endpoint='https://baybridge.ritis.org/speed/recent/',
+                    bb_endpoint='https://baybridge.ritis.org/status/',
+                    fixture_path=FIXTURE_PATH, data_path='./data/'):
+    """
+    Saves live speed and status responses as fixtures
+    (speed_{direction}.csv and status.json)
+    """
+    os.makedirs(fixture_path, exist_ok=True)
+    tmcs = ','.join(read_all_tmcs(data_path)[direction])
+    speed = http_get(speed_endpoint, params={'tmcs': tmcs, 'token': token}).content
+    with open(os.path.join(fixture_path, f'speed_{direction}.csv'), 'wb') as f:
+        f.write(speed)
+    status = http_get(bb_endpoint, params={'token': token}).content
+    with open(os.path.join(fixture_path, 'status.json'), 'wb') as f:
+        f.write(status)
+
+
+def _load_fixtures(direction, tmcs, asof):
+    # Recorded responses if present, a 60 minute synthetic payload otherwise
+    speed_file = os.path.join(FIXTURE_PATH, f'speed_{direction}.csv')
+    status_file = os.path.join(FIXTURE_PATH, 'status.json')
+    recorded = os.path.isfile(speed_file) and os.path.isfile(status_file)
+    if not recorded:
+        return synthetic_payload(tmcs, 60, asof), status_payload(), False
+    with open(speed_file, 'rb') as f:
+        speed = f.read()
+    with open(status_file, 'rb') as f:
+        status = f.read()
+    return speed, status, True
+
+
+def _serve(payload, status):
+    # All the payload tmcs are served, as if the direction had more tmcs
+    # (a request listing 100x tmcs would be too long for the stub)
+    speeds = pd.read_csv(io.BytesIO(payload), dtype=str)
+    server = StubServer(('127.0.0.1', 0), speeds, status, window=24 * 60,
+                        filter_tmcs=False)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_suite(direction='East', scales=SCALES, windows=WINDOWS, repeat=3,
+              data_path='./data/'):
+    """
+    Runs the stage benchmarks: the recorded (or 1x synthetic) payload, and
+    synthetic payloads with the direction tmcs plus generated ones, scaled
+    to each tmc count and window
+
+    Returns:
+        dict: {case: {'time_ms', 'peak_kib'}}, case is
+              'stage/payload', e.g. 'prepare_ml_data/10x_240min'
+    """
+    from modelzoo import ModelZoo
+
+    asof = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    tmcs = read_all_tmcs(data_path)[direction]
+    tmc_target = read_target_tmcs(data_path)[direction]
+    speed, status, recorded = _load_fixtures(direction, tmcs, asof)
+
+    payloads = {'recorded' if recorded else '1x_60min': speed}
+    for scale in scales:
+        extra = [f'999+{x:05d}' for x in range(len(tmcs) * (scale - 1))]
+        for window in windows:
+            if scale > 1 or window > 60 or recorded:
+                payloads[f'{scale}x_{window}min'] = synthetic_payload(tmcs + extra, window, asof)
+
+    modelzoo = ModelZoo(token='')
+    results = {}
+    status_json = json.loads(status)
+    status_name = 'recorded' if recorded else 'synthetic'
+    results[f'get_bb_current_status_df/{status_name}'] = measure(
+        lambda: get_bb_current_status_df(status_json), repeat)
+    results[f'parse_lane_status/{status_name}'] = measure(
+        lambda: parse_lane_status(status_json), repeat)
+
+    for name, payload in payloads.items():
+        server = _serve(payload, status)
+        try:
+            endpoint = f'http://127.0.0.1:{server.server_address[1]}/speed/recent/'
+            results[f'get_speed_data/{name}'] = measure(lambda: get_speed_data(
+                tmcs, speed_endpoint=endpoint, token=''), repeat)
+            raw = get_speed_data(tmcs, speed_endpoint=endpoint, token='')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        results[f'agg_speed_5m/{name}'] = measure(lambda: agg_speed_5m(raw), repeat)
+        speeds = agg_speed_5m(raw)
+        timestamps = [speeds.measurement_tstamp.max()]
+        lane_data = get_bb_base_status_df()
+
+        results[f'generate_queue_data/{name}'] = measure(
+            lambda: generate_queue_data(speeds, tmc_target), repeat)
+        queue_data = generate_queue_data(speeds, tmc_target)
+        results[f'prepare_ml_data/{name}'] = measure(lambda: prepare_ml_data(
+            tmcs, tmc_target, speeds, lane_data, queue_data), repeat)
+        results[f'features_latest/{name}'] = measure(
+            lambda: modelzoo.build_ml_data(direction, speeds, lane_data, expand=False), repeat)
+
+        # The models only know the direction tmcs, the estimate does not
+        # depend on the payload size
+        if name not in ['recorded', '1x_60min']:
+            continue
+        ml_data = modelzoo.build_ml_data(direction, speeds, lane_data, expand=False)
+        results[f'estimate/{name}'] = measure(lambda: modelzoo.estimate(
+            ml_data, direction, configurations=LANE_CONFIGURATIONS), repeat)
+        res_df = modelzoo.estimate(ml_data, direction, configurations=LANE_CONFIGURATIONS)
+        results[f'render_json/{name}'] = measure(lambda: render_json_body(res_df), repeat)
+        results[f'render_csv/{name}'] = measure(
+            lambda: render_csv(res_df, modelzoo.LINETERMINATOR), repeat)
+
+    return results
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE,
+            memory_tolerance=MEMORY_TOLERANCE):
+    """
+    Compares results with the baseline
+
+    Returns:
+        list: descriptions of the regressions (cases slower than
+              baseline * (1 + time_tolerance) or using more memory than
+              baseline * (1 + memory_tolerance))
+    """
+    regressions = []
+    for case, result in results.items():
+        if case not in baseline:
+            continue
+        base = baseline[case]
+        if result['time_ms'] > base['time_ms'] * (1 + time_tolerance):
+            regressions.append(f'{case}: {result["time_ms"]:.1f} ms, baseline {base["time_ms"]:.1f} ms')
+        if result['peak_kib'] > base['peak_kib'] * (1 + memory_tolerance):
+            regressions.append(f'{case}: {result["peak_kib"]:.0f} KiB, baseline {base["peak_kib"]:.0f} KiB')
+    return regressions
+
+
+def missing_cases(results, baseline):
+    """
+    Returns:
+        list: cases of the results without a baseline
+    """
+    return [case for case in results if case not in baseline]
+
+
+def bench_prepare_ml_data(tmc_counts=(50, 100, 200, 400),
+                          windows=(60, 120, 240, 480)):
+    print('prepare_ml_data [ms]')
+    print('tmcs ' + ''.join(f'{w:>10} min' for w in windows))
+    for n_tmcs in tmc_counts:
+        row = []
+        for window in windows:
+            speeds = synthetic_speeds(n_tmcs, window)
+            target = synthetic_target(speeds)
+            lane_data = get_bb_base_status_df()
+            queue_data = generate_queue_data(speeds.copy(), target)
+            row.append(timeit(lambda: prepare_ml_data(
+                tmc_list=list(target.tmc_code),
+                tmc_target=target,
+                speeds=speeds,
+                lane_data=lane_data,
+                queue_data=queue_data)))
+        print(f'{n_tmcs:>4} ' + ''.join(f'{x * 1000:>14.1f}' for x in row))
+
+
+def bench_generate_queue_data(days=(1, 7, 30), n_tmcs=120):
+    print('generate_queue_data [ms]')
+    print(f'{"days":>4} {"whole":>10} {"by day":>10}')
+    for n_days in days:
+        speeds = synthetic_speeds(n_tmcs, n_days * 24 * 60)
+        target = synthetic_target(speeds)
+        chunks = [x for _, x in speeds.groupby(speeds.measurement_tstamp.dt.floor('1D'))]
+        whole = timeit(lambda: generate_queue_data(speeds, target), repeat=1)
+        by_day = timeit(lambda: list(iter_queue_data(chunks, target)), repeat=1)
+        print(f'{n_days:>4} {whole * 1000:>10.1f} {by_day * 1000:>10.1f}')
+
+
+def bench_targeted_features(windows=(60, 240, 720, 1440), n_tmcs=70):
+    print('features for the latest timestamp [ms]')
+    print(f'{"window":>6} {"whole":>10} {"targeted":>10}')
+    for window in windows:
+        speeds = synthetic_speeds(n_tmcs, window)
+        target = synthetic_target(speeds, share=0.45)
+        lane_data = get_bb_base_status_df()
+        timestamps = [speeds.measurement_tstamp.max()]
+
+        def run(timestamps=None):
+            queue_data = generate_queue_data(speeds, target, timestamps=timestamps)
+            return prepare_ml_data(None, target, speeds, lane_data, queue_data,
+                                   timestamps=timestamps)
+
+        whole = timeit(lambda: run())
+        targeted = timeit(lambda: run(timestamps))
+        print(f'{window:>6} {whole * 1000:>10.1f} {targeted * 1000:>10.1f}')
+
+
+def bench_parse_speed_data(rows=(10_000, 100_000, 1_000_000)):
+    def split_astype(payload):
+        # The previous parsing of get_speed_data
+        lines = payload.decode().split('\n')[:-1]
+        df = pd.DataFrame([x.split(',') for x in lines[1:]], columns=lines[0].split(','))
+        df = df[SPEED_COLUMNS]
+        for c in ['speed', 'average_speed', 'reference_speed']:
+            df[c] = df[c].astype(int)
+        df.travel_time_minutes = df.travel_time_minutes.astype(float)
+        return df
+
+    print('speed response parsing [ms]')
+    print(f'{"rows":>8} {"split":>10} {"read_csv":>10}')
+    for n_rows in rows:
+        # One minute records, 60 per tmc
+        tmcs = [f'110+{x:05d}' for x in range(n_rows // 60)]
+        payload = synthetic_payload(tmcs, 60)
+
+        split = timeit(lambda: split_astype(payload), repeat=1)
+        typed = timeit(lambda: parse_speed_data(io.BytesIO(payload)))
+        print(f'{n_rows:>8} {split * 1000:>10.1f} {typed * 1000:>10.1f}')
+
+
+def bench_configurations(direction='East'):
+    from modelzoo import ModelZoo
+
+    modelzoo = ModelZoo(token='')
+    speeds = synthetic_speeds(0, 60, tmcs=modelzoo.tmcs_all_dict[direction])
+    ml_data = modelzoo.build_ml_data(direction, speeds, get_bb_base_status_df(),
+                                     expand=False)
+
+    print(f'{direction} estimates, all horizons [ms]')
+    for fast in [False, True]:
+        modelzoo.FAST_INFERENCE = fast
+        single = timeit(lambda: modelzoo.estimate(ml_data, direction), repeat=10)
+        replicated = timeit(lambda: modelzoo.estimate(
+            expand_configurations(ml_data, LANE_CONFIGURATIONS), direction), repeat=10)
+        batched = timeit(lambda: modelzoo.estimate(
+            ml_data, direction, configurations=LANE_CONFIGURATIONS), repeat=10)
+        print(f'FAST_INFERENCE={fast}: single configuration {single * 1000:.1f}, '
+              f'{len(LANE_CONFIGURATIONS)} replicated {replicated * 1000:.1f}, '
+              f'{len(LANE_CONFIGURATIONS)} batched {batched * 1000:.1f}')
+
+
+def bench_serialization(tmc_counts=(13, 50, 200)):
+    import json
+    from modelzoo import ModelZoo
+    from serialize import render_csv, render_json_body
+
+    modelzoo = ModelZoo(token='')
+
+    print('rendering of all horizons and configurations [ms]')
+    print(f'{"tmcs":>4} {"dumps":>10} {"json":>10} {"to_csv":>10} {"csv":>10}')
+    rng = np.random.default_rng(0)
+    for n_tmcs in tmc_counts:
+        speeds = synthetic_speeds(n_tmcs, 5)
+        res_df = speeds[['tmc_code', 'measurement_tstamp', 'reference_speed']].copy()
+        res_df['West'], res_df['East'] = 2, 3
+        res_df = res_df[['tmc_code', 'measurement_tstamp', 'West', 'East', 'reference_speed']]
+        res_df = expand_configurations(res_df, LANE_CONFIGURATIONS)
+        for horizon in range(5, 31, 5):
+            res_df[f'sr_pred_{horizon}'] = rng.uniform(0.3, 1.2, len(res_df)).astype(np.float32)
+
+        dumps = timeit(lambda: json.dumps(modelzoo.get_json_body_dic(res_df)), repeat=10)
+        body = timeit(lambda: render_json_body(res_df), repeat=10)
+        to_csv = timeit(lambda: res_df.to_csv(index=False, line_terminator='\\n'), repeat=10)
+        csv = timeit(lambda: render_csv(res_df, '\\n'), repeat=10)
+        print(f'{n_tmcs:>4} ' + ' '.join(f'{x * 1000:>10.2f}' for x in [dumps, body, to_csv, csv]))
+
+
+def bench_output_formats(tmc_counts=(13, 50, 200), chunks=(1, 288)):
+    import json
+    from serialize import read_arrow, render_arrow, render_csv, render_json_body
+
+    print('estimates of all horizons and configurations, encode/decode [ms] and size [KiB]')
+    print(f'{"tmcs":>4} {"steps":>5} {"format":>6} {"encode":>10} {"decode":>10} {"size":>10}')
+    rng = np.random.default_rng(0)
+    for n_tmcs in tmc_counts:
+        for steps in chunks:
+            # steps > 1: a backtest sized output, one 5 minute step per asof
+            speeds = synthetic_speeds(n_tmcs, 5 * steps)
+            res_df = speeds[['tmc_code', 'measurement_tstamp', 'reference_speed']].copy()
+            res_df['West'], res_df['East'] = 2, 3
+            res_df = res_df[['tmc_code', 'measurement_tstamp', 'West', 'East', 'reference_speed']]
+            res_df = expand_configurations(res_df, LANE_CONFIGURATIONS)
+            for horizon in range(5, 31, 5):
+                res_df[f'sr_pred_{horizon}'] = rng.uniform(0.3, 1.2, len(res_df)).astype(np.float32)
+
+            formats = {
+                'csv': (lambda: render_csv(res_df, '\n'),
+                        lambda x: pd.read_csv(io.StringIO(x))),
+                'arrow': (lambda: render_arrow(res_df), read_arrow),
+            }
+            if steps == 1:
+                # The json output has one timestamp per response
+                formats['json'] = (lambda: render_json_body(res_df), json.loads)
+            for name, (encode, decode) in formats.items():
+                payload = encode()
+                encode_time = timeit(encode, repeat=5)
+                decode_time = timeit(lambda: decode(payload), repeat=5)
+                size = len(payload if isinstance(payload, bytes) else payload.encode())
+                print(f'{n_tmcs:>4} {steps:>5} {name:>6} {encode_time * 1000:>10.2f} '
+                      f'{decode_time * 1000:>10.2f} {size / 1024:>10.1f}')
+
+
+def bench_startup(model_path='./models/'):
+    import tempfile
+    import joblib
+    from fastmodel import export_fast_pipeline
+    from modelbundle import ModelBundle, convert_pickles, model_keys
+
+    keys = model_keys()
+
+    def pickles(selected):
+        for key in selected:
+            export_fast_pipeline(joblib.load(os.path.join(model_path, keys[key])))
+
+    def bundle(path, selected):
+        models = ModelBundle(path)
+        models.check_sources(model_path)
+        for key in selected:
+            models.load(key)
+
+    print('model loading [ms]')
+    print(f'{"models":>6} {"pickles":>10} {"bundle":>10}')
+    with tempfile.TemporaryDirectory() as path:
+        convert_pickles(model_path, path)
+        for selected in [['East5'], list(keys)]:
+            times = [timeit(lambda: pickles(selected)),
+                     timeit(lambda: bundle(path, selected))]
+            print(f'{len(selected):>6} ' + ' '.join(f'{x * 1000:>10.1f}' for x in times))
+
+
+def _features_rss(dtype, window, direction, queue):
+    # Runs in a child process, so that ru_maxrss only covers this run
+    import resource
+    from modelzoo import ModelZoo
+
+    modelzoo = ModelZoo(token='')
+    speeds = synthetic_speeds(0, window, tmcs=modelzoo.tmcs_all_dict[direction])
+    target = modelzoo.target_tmcs_df_dict[direction]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    ml_data = prepare_ml_data(None, target, speeds, get_bb_base_status_df(),
+                              generate_queue_data(speeds, target), dtype=dtype)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    latest = ml_data[ml_data.measurement_tstamp == ml_data.measurement_tstamp.max()]
+    pred = modelzoo.estimate(latest, direction)
+    queue.put((peak - before, peak, ml_data.memory_usage(deep=True).sum(),
+               pred[[c for c in pred.columns if c.startswith('sr_pred')]].to_numpy()))
+
+
+def bench_memory(windows=(1440, 10080), direction='East'):
+    import multiprocessing
+
+    print(f'{direction} features of the whole window [MiB]')
+    print(f'{"window":>6} {"dtype":>8} {"RSS growth":>11} {"peak RSS":>9} {"frame":>8} '
+          f'{"max |pred - float64 pred|":>26}')
+    for window in windows:
+        reference = None
+        for dtype in [np.float64, np.float32]:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_features_rss,
+                                              args=(dtype, window, direction, queue))
+            process.start()
+            growth, peak, frame, pred = queue.get()
+            process.join()
+            reference = pred if reference is None else reference
+            diff = float(np.max(np.abs(pred - reference), initial=0))
+            # ru_maxrss is in KiB on Linux
+            print(f'{window:>6} {np.dtype(dtype).name:>8} {growth / 1024:>11.1f} '
+                  f'{peak / 1024:>9.1f} {frame / 2**20:>8.1f} {diff:>26.3g}')
+
+
+BENCHMARKS = {
+    'prepare_ml_data': bench_prepare_ml_data,
+    'generate_queue_data': bench_generate_queue_data,
+    'targeted_features': bench_targeted_features,
+    'parse_speed_data': bench_parse_speed_data,
+    'configurations': bench_configurations,
+    'serialization': bench_serialization,
+    'output_formats': bench_output_formats,
+    'startup': bench_startup,
+    'memory': bench_memory,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stage benchmarks and regression suite')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='Benchmarks comparing implementations, run instead of '
+                             f'the suite: {", ".join(BENCHMARKS)}')
+    parser.add_argument('-d', '--direction', default='East', choices=['East', 'West'])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--update-baseline', action='store_true',
+                        help='Store the results as the new baseline')
+    parser.add_argument('--record', action='store_true',
+                        help='Record the live responses as fixtures and exit')
+    parser.add_argument('-t', '--token', default=None, help='Token, for --record')
+    args = parser.parse_args()
+    unknown = [x for x in args.benchmarks if x not in BENCHMARKS]
+    if unknown:
+        parser.error(f'unknown benchmarks {unknown}')
+
+    if args.benchmarks:
+        for name in args.benchmarks:
+            BENCHMARKS[name]()
+            print()
+        sys.exit(0)
+
+    if args.record:
+        record_fixtures(args.token, args.direction)
+        sys.exit(0)
+
+    results = run_suite(args.direction, repeat=args.repeat)
+    baseline = {}
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f).get(args.direction, {})
+
+    width = max(len(x) for x in results)
+    print(f'{"case":<{width}} {"time [ms]":>10} {"peak [KiB]":>11} {"baseline":>10}')
+    for case, result in results.items():
+        base = baseline.get(case, {}).get('time_ms', '')
+        print(f'{case:<{width}} {result["time_ms"]:>10.2f} {result["peak_kib"]:>11.0f} {base:>10}')
+
+    if args.update_baseline:
+        stored = {}
+        if os.path.isfile(BASELINE_FILE):
+            with open(BASELINE_FILE) as f:
+                stored = json.load(f)
+        stored[args.direction] = results
+        os.makedirs(BENCH_PATH, exist_ok=True)
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(stored, f, indent=1, sort_keys=True)
+        print(f'Baseline stored in {BASELINE_FILE}')
+        sys.exit(0)
+
+    # Without a baseline the suite cannot pass: it compared nothing
+    if not baseline:
+        print(f'No {args.direction} baseline in {BASELINE_FILE}, run with --update-baseline to store one')
+        sys.exit(1)
+    missing = missing_cases(results, baseline)
+    for case in missing:
+        print(f'NO BASELINE {case}')
+    regressions = compare(results, baseline)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    sys.exit(1 if regressions or missing else 0)
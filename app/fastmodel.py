@@ -0,0 +1,229 @@
+# NumPy-only inference for the pickled model pipelines
+# (ColumnTransformer -> XGBRegressor). The fitted preprocessing parameters
+# are extracted once, so that at predict time we skip the pandas/sklearn
+# object overhead and only run array arithmetic and the xgboost booster.
+# Functions:
+# - export_fast_pipeline: Extracts a FastPipeline from a fitted Pipeline
+# - check_parity: Compares FastPipeline and Pipeline predictions
+
+import sys
+import numpy as np
+
+
+class FastPipeline:
+    """
+    Compact inference object, equivalent to a fitted Pipeline with
+    a 'num' (SimpleImputer median + StandardScaler) and a 'cat'
+    (OneHotEncoder) branch followed by an XGBRegressor.
+
+    Attributes:
+        num_columns (list): numeric input columns, in the fitted order
+        medians (np.ndarray): imputer medians for num_columns
+        means (np.ndarray): scaler means for num_columns
+        scales (np.ndarray): scaler scales for num_columns
+        cat_columns (list): categorical input columns, in the fitted order
+        categories (list): sorted categories of each categorical column
+        blocks (list): order of the 'num' and 'cat' blocks in the output
+        booster (xgb.Booster): fitted booster
+        iteration_range (tuple): trees used for predictions
+        missing (float): value treated as missing by the booster
+    """
+
+    def __init__(self, num_columns, medians, means, scales,
+                 cat_columns, categories, blocks,
+                 booster, iteration_range=(0, 0), missing=np.nan):
+        self.num_columns = list(num_columns)
+        self.medians = np.asarray(medians, dtype=np.float64)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.scales = np.asarray(scales, dtype=np.float64)
+        self.cat_columns = list(cat_columns)
+        self.categories = [np.asarray(x) for x in categories]
+        self.blocks = list(blocks)
+        self.booster = booster
+        self.iteration_range = tuple(iteration_range)
+        self.missing = missing
+
+    @property
+    def n_features(self):
+        return len(self.num_columns) + sum(len(x) for x in self.categories)
+
+    def transform_num(self, X):
+        """
+        Imputes and scales numeric features
+        Args:
+            X (np.ndarray): float64 array with num_columns
+        Returns:
+            np.ndarray: transformed array (float64)
+        """
+        X = np.where(np.isnan(X), self.medians, X)
+        X -= self.means
+        X /= self.scales
+        return X
+
+    def transform_cat(self, X):
+        """
+        One-hot encodes categorical features. Unknown values are encoded
+        as all zeros.
+        Args:
+            X (np.ndarray): array with cat_columns
+        Returns:
+            np.ndarray: one-hot encoded array (float64)
+        """
+        blocks = []
+        for i, categories in enumerate(self.categories):
+            values = X[:, i]
+            idx = np.searchsorted(categories, values)
+            idx[idx == len(categories)] = 0
+            known = categories[idx] == values
+            block = np.zeros((len(values), len(categories)))
+            block[np.flatnonzero(known), idx[known]] = 1
+            blocks.append(block)
+        return np.hstack(blocks)
+
+    def transform(self, df):
+        """
+        Transforms a feature frame into the booster input matrix
+        Args:
+            df (pd.DataFrame): ML data, as returned by prepare_ml_data
+        Returns:
+            np.ndarray: float32 matrix with n_features columns
+        """
+        parts = {
+            'num': lambda: self.transform_num(
+                df[self.num_columns].to_numpy(dtype=np.float64)),
+            'cat': lambda: self.transform_cat(
+                df[self.cat_columns].to_numpy()),
+        }
+        X = np.hstack([parts[x]() for x in self.blocks])
+        return X.astype(np.float32)
+
+    def transform_configurations(self, df, configurations):
+        """
+        Transforms a feature frame replicated for each configuration, as
+        expand_configurations(df, configurations) would be. The frame is
+        transformed once; only the configuration columns are scaled for
+        each configuration.
+        Args:
+            df (pd.DataFrame): ML data, as returned by prepare_ml_data
+            configurations (pd.DataFrame): configuration columns (numeric
+                features, e.g. East and West) and their values
+        Returns:
+            np.ndarray: float32 matrix with n_features columns,
+                        configuration major
+        """
+        X = np.tile(self.transform(df), (len(configurations), 1))
+        offset = 0
+        for block in self.blocks:
+            if block == 'cat':
+                offset += sum(len(x) for x in self.categories)
+                continue
+            for col in configurations.columns:
+                i = self.num_columns.index(col)
+                values = configurations[col].to_numpy(dtype=np.float64)
+                values = (values - self.means[i]) / self.scales[i]
+                X[:, offset + i] = np.repeat(values, len(df)).astype(np.float32)
+            offset += len(self.num_columns)
+        return X
+
+    def predict_transformed(self, X):
+        """
+        Predicts on a matrix returned by transform
+        """
+        return self.booster.inplace_predict(
+            X,
+            iteration_range=self.iteration_range,
+            missing=self.missing)
+
+    def predict(self, df):
+        return self.predict_transformed(self.transform(df))
+
+
+def export_fast_pipeline(pipeline):
+    """
+    Extracts a FastPipeline from a fitted Pipeline
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): pipeline with a ColumnTransformer
+            ('num': SimpleImputer + StandardScaler, 'cat': OneHotEncoder,
+            remainder dropped) followed by an XGBRegressor
+
+    Returns:
+        FastPipeline: equivalent inference object
+    """
+
+    preprocessor, model = pipeline.steps[0][1], pipeline.steps[-1][1]
+
+    blocks = []
+    for name, transformer, columns in preprocessor.transformers_:
+        if name in ['num', 'cat']:
+            blocks.append(name)
+        elif transformer != 'drop' and len(columns) > 0:
+            raise ValueError(f'Unsupported transformer {name}')
+
+    num = preprocessor.named_transformers_['num']
+    imputer, scaler = num.named_steps['imputer'], num.named_steps['scaler']
+    num_columns = list(preprocessor.transformers_[blocks.index('num')][2])
+    medians = imputer.statistics_
+
+    # SimpleImputer drops columns that were all missing during fit
+    valid = ~np.isnan(medians)
+    num_columns = [c for c, v in zip(num_columns, valid) if v]
+    medians = medians[valid]
+
+    encoder = preprocessor.named_transformers_['cat']
+    if encoder.drop is not None or encoder.handle_unknown != 'ignore':
+        raise ValueError('Only OneHotEncoder(handle_unknown="ignore") is supported')
+    cat_columns = list(preprocessor.transformers_[blocks.index('cat')][2])
+
+    try:
+        iteration_range = (0, model.best_iteration + 1)
+    except AttributeError:
+        iteration_range = (0, 0)
+
+    return FastPipeline(
+        num_columns=num_columns,
+        medians=medians,
+        means=scaler.mean_ if scaler.with_mean else np.zeros(len(medians)),
+        scales=scaler.scale_ if scaler.with_std else np.ones(len(medians)),
+        cat_columns=cat_columns,
+        categories=encoder.categories_,
+        blocks=blocks,
+        booster=model.get_booster(),
+        iteration_range=iteration_range,
+        missing=model.missing)
+
+
+def check_parity(pipeline, fast_pipeline, ml_data):
+    """
+    Compares FastPipeline and Pipeline predictions on the same data
+
+    Args:
+        pipeline (sklearn.pipeline.Pipeline): fitted pipeline
+        fast_pipeline (FastPipeline): pipeline exported with export_fast_pipeline
+        ml_data (pd.DataFrame): ML data, as returned by prepare_ml_data
+
+    Returns:
+        float: maximum absolute difference between the predictions
+    """
+    expected = pipeline.predict(ml_data)
+    actual = fast_pipeline.predict(ml_data)
+    return float(np.max(np.abs(expected - actual), initial=0))
+
+
+if __name__ == '__main__':
+    # Usage: python fastmodel.py DIRECTION RECORDED_ML_DATA.pkl
+    # Checks all horizons of a direction against recorded ML data
+    # (a pickled DataFrame, as returned by ModelZoo.get_data_now)
+    import pandas as pd
+    from modelzoo import ModelZoo
+
+    direction, recorded = sys.argv[1], sys.argv[2]
+    ml_data = pd.read_pickle(recorded)
+    modelzoo = ModelZoo()
+    failed = False
+    for horizon in range(5, 31, 5):
+        pipeline = modelzoo.model_dict[f'{direction}{horizon}']
+        diff = check_parity(pipeline, export_fast_pipeline(pipeline), ml_data)
+        print(f'{direction}{horizon}: max abs difference {diff}')
+        failed = failed or diff > 0
+    sys.exit(1 if failed else 0)
@@ -2,22 +2,163 @@
 # and process them to Pandas DataFrames
 # Functions:
 # - connect_bb: Connects to bb API if not conneted
+# - configure_http: Configures the shared HTTP client (pool, timeouts, retries)
+# - http_get: GET request through the shared HTTP client
+# - configure_archive: Enables or disables the local archive of pulls
+# - get_archived_speed_data: Reads speeds of a time range from the archive
 # - get_bb_data: Gets bb configuration data from baybridge.ritis.org website
 # - get_speed_data: Gets recent speed data from baybridge.ritis.org website
+# - get_speed_data_ranges: Gets the speeds of time ranges, one window per request
+# - parse_speed_data: Parses a csv response of the speed endpoint
+# - parse_lane_status: Derives the lane statuses and counts from get_bb_data output
+# - lane_status_df: Builds the lane status dataframe of parse_lane_status output
+# - archive_status: Writes a lane status to the archive, if enabled
 # - get_bb_current_status_df: Transforms get_bb_data output into a dataframe
 # = get_bb_base_status_df: Produces a dataframe with base Baybridge status (2W, 3E)
 # - agg_speed_5m: Aggregates dataframe with speeds to 5 minute granulation
 # - read_all_tmcs: Reads all tmcs of interests
 # - read_target_tmcs: Loads the target tmcs dataframes
 
+import os
 from os import path
+import threading
 import pandas as pd
 
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 
 import urllib.parse
 from json import loads
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from speedarchive import SpeedArchive
+from metrics import METRICS
+
+
+HTTP_SETTINGS = {
+    'connect_timeout': 3.05,
+    'read_timeout': 30,
+    'retries': 3,
+    'backoff_factor': 0.5,
+    'pool_maxsize': 10,
+}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+SPEED_COLUMNS = [
+    'tmc_code', 'measurement_tstamp',
+    'speed', 'average_speed', 'reference_speed', 'travel_time_minutes'
+]
+SPEED_DTYPES = {
+    'tmc_code': 'category',
+    'speed': 'int64',
+    'average_speed': 'int64',
+    'reference_speed': 'int64',
+    'travel_time_minutes': 'float64',
+}
+
+_http_lock = threading.Lock()
+_http_session = {'pid': None, 'session': None}
+_archive = {'archive': None}
+
+
+def configure_http(**settings):
+    """
+    Configures the shared HTTP client used by get_bb_data and get_speed_data.
+    The session is recreated on next use.
+
+    Args:
+        connect_timeout (float): connect timeout [s]
+        read_timeout (float): read timeout [s]
+        retries (int): number of retries of failed connections, reads and
+                       429/5xx responses
+        backoff_factor (float): retries wait backoff_factor * 2^(retry - 1) [s]
+        pool_maxsize (int): number of kept-alive connections per host
+    """
+    unknown = set(settings) - set(HTTP_SETTINGS)
+    if unknown:
+        raise ValueError(f'Unknown HTTP settings: {sorted(unknown)}')
+    with _http_lock:
+        HTTP_SETTINGS.update(settings)
+        _http_session['session'] = None
+
+
+def _get_session():
+    # One session (connection pool) per process. Sockets are not shared with
+    # forked service workers.
+    with _http_lock:
+        if _http_session['session'] is None or _http_session['pid'] != os.getpid():
+            retry = Retry(
+                total=HTTP_SETTINGS['retries'],
+                backoff_factor=HTTP_SETTINGS['backoff_factor'],
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(['GET']),
+                raise_on_status=False)
+            adapter = HTTPAdapter(
+                pool_connections=HTTP_SETTINGS['pool_maxsize'],
+                pool_maxsize=HTTP_SETTINGS['pool_maxsize'],
+                max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            _http_session['session'] = session
+            _http_session['pid'] = os.getpid()
+        return _http_session['session']
+
+
+def http_get(url, **kwargs):
+    """
+    GET request through the shared HTTP client (keep-alive connection pool,
+    connect/read timeouts, retries with backoff, gzip).
+
+    Args:
+        url (str): requested url
+        kwargs: passed to requests.Session.get
+
+    Returns:
+        requests.Response: response with a successful status
+
+    Raises:
+        requests.RequestException: if the request still fails after retries
+    """
+    kwargs.setdefault('timeout', (HTTP_SETTINGS['connect_timeout'],
+                                  HTTP_SETTINGS['read_timeout']))
+    response = _get_session().get(url, **kwargs)
+    response.raise_for_status()
+    return response
+
+
+def configure_archive(path=None):
+    """
+    Enables the local archive of pulls: every response of get_speed_data and
+    get_bb_data is also written to a SpeedArchive in path.
+
+    Args:
+        path (str, optional): archive directory. None disables the archive.
+    """
+    _archive['archive'] = None if path is None else SpeedArchive(path)
+
+
+def get_archived_speed_data(tmc_list, start, end, archive_path=None):
+    """
+    Reads speeds of a time range from the local archive, instead of the
+    speed endpoint. Only the day partitions of the range are read.
+
+    Args:
+        tmc_list (list): list of tmcs to get data for. All tmcs if None.
+        start (datetime): first measurement timestamp (included)
+        end (datetime): last measurement timestamp (included)
+        archive_path (str, optional): archive directory. The archive set
+                                      with configure_archive if None.
+    Returns:
+        pd.DataFrame: DataFrame with speeds, as returned by get_speed_data
+    """
+    archive = _archive['archive'] if archive_path is None else SpeedArchive(archive_path)
+    if archive is None:
+        raise ValueError('No speed archive configured')
+    return archive.read_speeds(start, end, tmc_list)
+
 
 def get_bb_data(bb_endpoint='https://baybridge.ritis.org/status/',
                 token=None):
@@ -41,8 +182,13 @@ def get_bb_data(bb_endpoint='https://baybridge.ritis.org/status/',
 
     bb_endpoint = f'{bb_endpoint}?token={token}'
  
-    html_bb = requests.get(bb_endpoint).text  
-    ret_bb = loads(html_bb)
+    with METRICS.timer('status_request'):
+        html_bb = http_get(bb_endpoint).text  
+        ret_bb = loads(html_bb)
+
+    # The status is only parsed when it is archived
+    if _archive['archive'] is not None:
+        archive_status(parse_lane_status(ret_bb))
 
     return ret_bb
 
@@ -73,23 +219,134 @@ def get_speed_data(tmc_list,
         asof = str(asof.replace(tzinfo=None)) + 'Z'
         link = f'{speed_endpoint}?tmcs={tmc_str}&asOf={asof}&token={token}'
         
-    html = requests.get(link).text        
-    lines =  html.split('\n')[:-1]
-    df = pd.DataFrame([x.split(',') for x in lines[1:]], columns = lines[0].split(','))
-
-    # Let's do a sanity check here, to be sure that we have right columns in
-    # the right order
-    df = df [[
-        'tmc_code','measurement_tstamp',
-        'speed','average_speed','reference_speed','travel_time_minutes'
-        ]]
-
-    for c in ['speed','average_speed','reference_speed']:
-        df[c] = df[c].astype(int)
-    df.travel_time_minutes = df.travel_time_minutes.astype(float)
-        
+    with METRICS.timer('speed_request'), http_get(link, stream=True) as response:
+        # Decompress (gzip) while reading the raw stream
+        response.raw.decode_content = True
+        df = parse_speed_data(response.raw)
+    METRICS.count('speed_request', len(df))
+
+    if _archive['archive'] is not None:
+        _archive['archive'].write_speeds(df)
+
     return df 
 
+def get_speed_data_ranges(tmc_list, ranges, window = 60,
+                          speed_endpoint = 'https://baybridge.ritis.org/speed/recent/',
+                          token = None):
+    """
+    Gets the speeds of time ranges longer than the endpoint window. Each
+    range is covered by consecutive requests (get_speed_data), as of its
+    end, then window minutes earlier, and so on. Overlapping ranges are
+    merged, so each window is requested once.
+
+    Args:
+        tmc_list (list): list of tmcs to get data for
+        ranges (list): (start, end) pairs of UTC datetimes (both included)
+        window (int): minutes of records the endpoint returns before asOf.
+                      It must not be longer than the endpoint window.
+        speed_endpoint: endpoint for speeds
+        token: token for endpoints
+    Returns:
+        pd.DataFrame: DataFrame with speeds, as returned by get_speed_data,
+                      without duplicated records
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    pulls = []
+    for start, end in merged:
+        asof = end
+        while asof >= start:
+            pulls.append(get_speed_data(tmc_list, speed_endpoint = speed_endpoint,
+                                        asof = asof, token = token))
+            asof -= timedelta(minutes = window)
+
+    df = pd.concat(pulls, ignore_index = True)
+    df = df.drop_duplicates(['tmc_code', 'measurement_tstamp']).reset_index(drop = True)
+    df['tmc_code'] = df['tmc_code'].astype('category')
+    return df
+
+def parse_speed_data(stream):
+    """
+    Parses a csv response of the speed endpoint
+
+    Args:
+        stream: file-like object with the csv bytes
+
+    Returns:
+        pd.DataFrame: DataFrame with speeds
+    """
+
+    # usecols works as a sanity check too: it fails if a column is missing
+    df = pd.read_csv(stream,
+                     usecols=SPEED_COLUMNS,
+                     dtype=SPEED_DTYPES,
+                     parse_dates=['measurement_tstamp'])
+
+    # Let's be sure that we have the columns in the right order
+    return df[SPEED_COLUMNS]
+
+def parse_lane_status(json_file):
+    """
+    Derives the lane statuses from output of baybridge API, without pandas.
+    A lane is open in its default direction (L1-L3 West, L4-L5 East), in
+    the other direction if it is contraflow, or closed (0).
+
+    Args:
+        json_file (dict): parsed jsonfile of current bb status
+
+    Returns:
+        tuple: (statuses, West, East), statuses is a tuple with the status
+               ('W', 'E' or 0) of each lane, in lane order
+    """
+    lanes = json_file['status']['lanes']
+    statuses = []
+    for lane in sorted(lanes):
+        flags = lanes[lane]
+        default = 'W' if lane in ('L1', 'L2', 'L3') else 'E'
+        if flags['isContraflow']:
+            statuses.append('E' if default == 'W' else 'W')
+        elif flags['isClosed']:
+            statuses.append(0)
+        else:
+            statuses.append(default)
+    return tuple(statuses), statuses.count('W'), statuses.count('E')
+
+def lane_status_df(lane_status, tstamp=None):
+    """
+    Builds the lane status dataframe (get_bb_current_status_df format)
+
+    Args:
+        lane_status (tuple): output of parse_lane_status
+        tstamp (datetime, optional): measurement_tstamp, now by default
+
+    Returns:
+        pd.DataFrame: DataFrame with the bb status
+    """
+    statuses, west, east = lane_status
+    if tstamp is None:
+        tstamp = datetime.now(timezone.utc)
+    columns = [f'L{i + 1}status' for i in range(len(statuses))]
+    df = pd.DataFrame([[tstamp, *statuses, west, east]],
+                      columns=['measurement_tstamp'] + columns + ['West', 'East'])
+    return df
+
+def archive_status(lane_status, tstamp=None):
+    """
+    Writes a lane status to the archive (see configure_archive). The
+    dataframe is only built if the archive is enabled.
+
+    Args:
+        lane_status (tuple): output of parse_lane_status
+        tstamp (datetime, optional): measurement_tstamp, now by default
+    """
+    if _archive['archive'] is not None:
+        _archive['archive'].write_status(lane_status_df(lane_status, tstamp))
+
 def get_bb_current_status_df(json_file):
     """
     Transforms output from baybridge API into a dataframe
@@ -100,26 +357,7 @@ def get_bb_current_status_df(json_file):
     Returns:
         pd.DataFrame: DataFrame with current bb status
     """
-    
-    dfs = pd.DataFrame(json_file['status'])
-    dfs[['isClosed', 'isContraflow', 'defaultDirection', 'direction']]=dfs['lanes'].apply(pd.Series)
-    dfs['status'] = 1
-    dfs.loc[dfs.isClosed, 'status'] = 0
-    dfs.loc[dfs.isContraflow, 'status'] = -1
-    df_time = dfs.sort_index()[['status']].T
-    df_time.columns = [f'{x}status' for x in df_time.columns]
-
-    df_time[['L1status', 'L2status', 'L3status']]=df_time[['L1status', 'L2status', 'L3status']].replace(1,'W')
-    df_time[['L1status', 'L2status', 'L3status']]=df_time[['L1status', 'L2status', 'L3status']].replace(-1,'E')
-    df_time[['L4status','L5status']]=df_time[['L4status','L5status']].replace(1,'E')
-    df_time[['L4status','L5status']]=df_time[['L4status','L5status']].replace(-1,'W')
-
-
-    df_time['West']=df_time[df_time=='W'].count(axis=1)
-    df_time['East']=df_time[df_time=='E'].count(axis=1)
-    df_time['measurement_tstamp'] = datetime.now(timezone.utc)
-    cols = ['measurement_tstamp','L1status','L2status','L3status','L4status','L5status','West','East']
-    return df_time[cols]
+    return lane_status_df(parse_lane_status(json_file))
 
 def get_bb_base_status_df():
     """
@@ -154,13 +392,13 @@ def agg_speed_5m(df):
     """
     Aggregates dataframe with speeds to 5 minute granulation
     Args:
-        df (pd.DataFrame): DataFrame with speed data
+        df (pd.DataFrame): DataFrame with speed data. It is not modified.
     Returns:
         pd.DataFrame: aggregated dataframe with speed data
     """
 
-    df.measurement_tstamp = pd.to_datetime(df.measurement_tstamp, utc=True).dt.floor("5min")
-    df = df.groupby(['tmc_code', 'measurement_tstamp']).agg({
+    tstamps = pd.to_datetime(df['measurement_tstamp'], utc=True).dt.floor("5min")
+    df = df.groupby([df['tmc_code'], tstamps], observed=True).agg({
         'speed' : 'mean',
         'average_speed' : 'mean',
         'reference_speed' : 'mean',
@@ -1,7 +1,12 @@
 import sys
 import os
 import argparse
+from json import dumps
 from modelzoo import ModelZoo
+import service
+import backtest
+from metrics import METRICS
+from scheduler import PrecomputeScheduler
 
 parser = argparse.ArgumentParser(description='Generate BayBridge Estimates')
 
@@ -26,8 +31,8 @@ parser.add_argument('-b', '--bbendpoint',
 parser.add_argument('-d', '--direction',
                     type=str,
                     default='East',
-                    choices=['East', 'West'],
-                    help='Traffic direction'
+                    choices=['East', 'West', 'both'],
+                    help='Traffic direction. both: estimates of both directions in one run'
                    )
 
 parser.add_argument('-f', '--forecasthorizon',
@@ -40,13 +45,73 @@ parser.add_argument('-f', '--forecasthorizon',
 parser.add_argument('-o', '--outputformat',
                     type=str,
                     default='json',
-                    choices=['json', 'csv', 'df'],
-                    help='Output format'
+                    choices=['json', 'csv', 'arrow', 'df'],
+                    help='Output format. arrow is an Arrow IPC stream, written as binary'
+                   )
+
+parser.add_argument('--serve',
+                    action='store_true',
+                    help='Run as a long-running HTTP service instead of producing one estimate'
+                   )
+
+parser.add_argument('--host',
+                    type=str,
+                    default='0.0.0.0',
+                    help='Service host. Default: 0.0.0.0'
+                   )
+
+parser.add_argument('--port',
+                    type=int,
+                    default=5000,
+                    help='Service port. Default: 5000'
+                   )
+
+parser.add_argument('-w', '--workers',
+                    type=int,
+                    default=1,
+                    help='Number of service (or backtest) worker processes. Default: 1'
+                   )
+
+parser.add_argument('--profile',
+                    action='store_true',
+                    help='Print the time spent in each stage of the estimate to stderr'
+                   )
+
+parser.add_argument('--backtest',
+                    type=str,
+                    nargs=2,
+                    default=None,
+                    metavar=('START', 'END'),
+                    help='Run the models over a time range (UTC) instead of producing one estimate'
+                   )
+
+parser.add_argument('--step',
+                    type=int,
+                    default=5,
+                    help='Backtest step [min]. Default: 5'
+                   )
+
+parser.add_argument('--chunk',
+                    type=int,
+                    default=6,
+                    help='Backtest timestamps sharing one speed request. Default: 6'
+                   )
+
+parser.add_argument('--output',
+                    type=str,
+                    default='backtest.parquet',
+                    help='Backtest output file, parquet or Arrow IPC stream (.arrow). Default: backtest.parquet'
                    )
 
 
 
 def estimate_now(args):        
+    if args.direction == 'both':
+        return modelzoo.estimate_all_directions(
+            forecast_horizon=args.forecasthorizon,
+            read_config=False,
+            outputformat=args.outputformat)
+
     res = modelzoo.estimate_now(
         direction=args.direction, 
         forecast_horizon=args.forecasthorizon, 
@@ -56,10 +121,60 @@ def estimate_now(args):
     return res
 
 
+def create_app():
+    """
+    Application factory used by `flask run`. Endpoints and token are read
+    from BBQ_SPEED_ENDPOINT, BBQ_BB_ENDPOINT and BBQ_TOKEN environment
+    variables (parser defaults are used if they are not set).
+    """
+    args = parser.parse_args([])
+    modelzoo = ModelZoo(
+        bb_endpoint=os.environ.get('BBQ_BB_ENDPOINT', args.bbendpoint),
+        speed_endpoint=os.environ.get('BBQ_SPEED_ENDPOINT', args.speedendpoint),
+        token=os.environ.get('BBQ_TOKEN', args.token)
+    )
+    scheduler = None
+    if modelzoo.PRECOMPUTE:
+        scheduler = PrecomputeScheduler(modelzoo, offset=modelzoo.PRECOMPUTE_OFFSET)
+        scheduler.start()
+    return service.create_app(modelzoo, scheduler)
+
+
 
 if __name__ == '__main__':
     args = parser.parse_args()
     
+    if args.serve:
+        modelzoo = ModelZoo(
+            bb_endpoint=args.bbendpoint,
+            speed_endpoint=args.speedendpoint,
+            token=args.token
+        )
+        # Workers are forked after the models are loaded and share them
+        modelzoo.preload_models()
+        scheduler = None
+        if modelzoo.PRECOMPUTE:
+            scheduler = PrecomputeScheduler(modelzoo, offset=modelzoo.PRECOMPUTE_OFFSET)
+        service.serve(service.create_app(modelzoo, scheduler),
+                      host=args.host,
+                      port=args.port,
+                      workers=args.workers)
+        sys.exit(0)
+
+    if args.backtest:
+        directions = ['East', 'West'] if args.direction == 'both' else [args.direction]
+        stats = backtest.run_backtest(
+            backtest.backtest_timestamps(*args.backtest, step=args.step),
+            output=args.output,
+            directions=directions,
+            forecast_horizon=args.forecasthorizon,
+            speed_endpoint=args.speedendpoint,
+            token=args.token,
+            chunk=args.chunk,
+            workers=args.workers)
+        print(dumps(stats))
+        sys.exit(0)
+
     old_stdout = sys.stdout
     with open(os.devnull, 'w') as f:
         sys.stdout = f
@@ -68,10 +183,18 @@ if __name__ == '__main__':
             speed_endpoint=args.speedendpoint,
             token=args.token
         )
+        if args.profile:
+            METRICS.enabled = True
+            METRICS.reset()
         estimates = estimate_now(args)
     
     sys.stdout = old_stdout
-    print (estimates)
+    if isinstance(estimates, bytes):
+        sys.stdout.buffer.write(estimates)
+    else:
+        print (estimates)
+    if args.profile:
+        print(METRICS.breakdown(), file=sys.stderr)
 
 
-    
\ No newline at end of file
+    
\ No newline at end of file
@@ -0,0 +1,168 @@
+# Per-stage latency and row counts of the estimates. Stages are timed with
+# METRICS.timer(stage, **labels) and aggregated in histograms, exposed in the
+# Prometheus text format by the service (/metrics) and as a table by the
+# command line (--profile). When disabled, timers are a shared no-op.
+# Classes:
+# - Metrics: Thread-safe registry of stage latency histograms and row counts
+# Objects:
+# - METRICS: registry used by the application
+
+import bisect
+import threading
+import time
+from contextlib import nullcontext
+
+
+# Upper bounds of the latency histogram buckets [s]
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+           0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_NULL_TIMER = nullcontext()
+
+
+class _Timer:
+    __slots__ = ('metrics', 'key', 'start')
+
+    def __init__(self, metrics, key):
+        self.metrics = metrics
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics._observe(self.key, time.perf_counter() - self.start)
+        return False
+
+
+def _key(stage, labels):
+    return (stage, ) + tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _label_str(key, extra=()):
+    labels = [('stage', key[0])] + list(key[1:]) + list(extra)
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """
+    Thread-safe registry of stage latency histograms and row counts
+
+    Attributes:
+        enabled (bool): if False, timer() and count() do nothing
+        buckets (tuple): upper bounds of the histogram buckets [s]
+    """
+
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # {key: [bucket counts (last one is +Inf), sum, count, max]}
+            self.histograms = {}
+            # {key: [rows, columns]}, rows summed, columns of the last call
+            self.counts = {}
+
+    def timer(self, stage, **labels):
+        """
+        Returns a context manager that records the time spent in its block
+
+        Args:
+            stage (str): stage name
+            labels: additional labels (e.g. horizon=5)
+        """
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, _key(stage, labels))
+
+    def _observe(self, key, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0, 0.0]
+            histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            histogram[3] = max(histogram[3], seconds)
+
+    def observe(self, stage, seconds, **labels):
+        """
+        Records the time spent in a stage [s]
+        """
+        if self.enabled:
+            self._observe(_key(stage, labels), seconds)
+
+    def count(self, stage, rows, columns=None, **labels):
+        """
+        Records the rows (and columns, e.g. features) produced by a stage
+        """
+        if not self.enabled:
+            return
+        key = _key(stage, labels)
+        with self.lock:
+            counts = self.counts.setdefault(key, [0, None])
+            counts[0] += rows
+            if columns is not None:
+                counts[1] = columns
+
+    def render_prometheus(self, prefix='bbq'):
+        """
+        Returns:
+            str: histograms and counts in the Prometheus text format
+        """
+        with self.lock:
+            histograms = {k: (list(v[0]), v[1], v[2]) for k, v in self.histograms.items()}
+            counts = {k: list(v) for k, v in self.counts.items()}
+
+        lines = [f'# HELP {prefix}_stage_seconds Time spent in the estimate stages',
+                 f'# TYPE {prefix}_stage_seconds histogram']
+        for key, (buckets, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ('+Inf', ), buckets):
+                cumulative += n
+                lines.append(f'{prefix}_stage_seconds_bucket'
+                             f'{_label_str(key, [("le", bound)])} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{_label_str(key)} {total!r}')
+            lines.append(f'{prefix}_stage_seconds_count{_label_str(key)} {count}')
+
+        lines += [f'# HELP {prefix}_stage_rows_total Rows produced by the estimate stages',
+                  f'# TYPE {prefix}_stage_rows_total counter']
+        lines += [f'{prefix}_stage_rows_total{_label_str(key)} {rows}'
+                  for key, (rows, _) in sorted(counts.items())]
+        lines += [f'# HELP {prefix}_stage_columns Columns produced by the last call of a stage',
+                  f'# TYPE {prefix}_stage_columns gauge']
+        lines += [f'{prefix}_stage_columns{_label_str(key)} {columns}'
+                  for key, (_, columns) in sorted(counts.items()) if columns is not None]
+        return '\n'.join(lines) + '\n'
+
+    def breakdown(self):
+        """
+        Returns:
+            str: table with calls, total, mean and max time [ms] and rows of
+                 each stage, in the order the stages were first seen
+        """
+        with self.lock:
+            histograms = {k: list(v[1:]) for k, v in self.histograms.items()}
+            counts = {k: list(v) for k, v in self.counts.items()}
+
+        names = {key: ' '.join([key[0]] + [f'{k}={v}' for k, v in key[1:]])
+                 for key in list(histograms) + list(counts)}
+        width = max([len(x) for x in names.values()] + [5])
+        lines = [f'{"stage":<{width}} {"calls":>6} {"total":>10} {"mean":>10} '
+                 f'{"max":>10} {"rows":>8} {"columns":>8}']
+        for key, name in names.items():
+            total, calls, longest = histograms.get(key, (0.0, 0, 0.0))
+            rows, columns = counts.get(key, ('', ''))
+            mean = total / calls if calls else 0.0
+            lines.append(f'{name:<{width}} {calls:>6} {total * 1000:>10.2f} '
+                         f'{mean * 1000:>10.2f} {longest * 1000:>10.2f} '
+                         f'{rows:>8} {"" if columns is None else columns:>8}')
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()
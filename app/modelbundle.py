@@ -0,0 +1,241 @@
+# Versioned on-disk bundle of the models, in a format that is fast to load.
+# Each model is stored as an xgboost UBJSON booster plus its preprocessing
+# parameters as .npy arrays (memory-mapped when loaded), and a manifest
+# lists the models, their fingerprints and the pickles they come from.
+# Usage: python modelbundle.py [MODEL_PATH] [BUNDLE_PATH]
+#        converts the model_*.pkl pickles of MODEL_PATH into a bundle
+# Classes:
+# - LazyDict: Read-only mapping that loads its values on first access
+# - ModelBundle: Reads a bundle, loading FastPipelines per model key
+# Functions:
+# - model_keys: Returns the model keys and their pickle file names
+# - convert_pickles: Converts the pickled Pipelines into a bundle
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from collections.abc import Mapping
+
+import joblib
+import numpy as np
+import xgboost as xgb
+
+from fastmodel import FastPipeline, export_fast_pipeline
+
+
+BUNDLE_FORMAT = 'bbq-model-bundle'
+BUNDLE_VERSION = 1
+MANIFEST = 'manifest.json'
+
+
+def model_keys():
+    """
+    Returns:
+        dict: {'{direction}{horizon}': pickle file name} for all models
+    """
+    return {
+        f'{direction}{horizon}': f'model_{direction}_{horizon}_min.pkl'
+        for direction in ['East', 'West']
+        for horizon in range(5, 31, 5)
+    }
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _stat(path):
+    # Size and modification time, compared before hashing a source pickle
+    stat = os.stat(path)
+    return {'source_size': stat.st_size, 'source_mtime_ns': stat.st_mtime_ns}
+
+
+class LazyDict(Mapping):
+    """
+    Read-only mapping of a fixed set of keys, whose values are produced by
+    loader(key) on first access and kept afterwards
+    """
+
+    def __init__(self, keys, loader):
+        self._keys = list(keys)
+        self._loader = loader
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        if key not in self._keys:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = self._loader(key)
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def loaded(self):
+        """
+        Returns:
+            list: keys whose values were already loaded
+        """
+        return list(self._values)
+
+
+class ModelBundle:
+    """
+    Reads a model bundle written by convert_pickles
+
+    Attributes:
+        path (str): bundle directory
+        manifest (dict): content of the manifest
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST), 'r') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format') != BUNDLE_FORMAT:
+            raise ValueError(f'{path} is not a model bundle')
+        if self.manifest.get('version') != BUNDLE_VERSION:
+            raise ValueError(f'Unsupported model bundle version {self.manifest.get("version")} '
+                             f'(expected {BUNDLE_VERSION}). Run modelbundle.py again.')
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, MANIFEST))
+
+    def keys(self):
+        return list(self.manifest['models'])
+
+    def fingerprint(self, key):
+        """
+        Returns the hash of the fitted preprocessing steps of the model
+        (joblib.hash(pipeline[:-1])), without loading the model
+        """
+        return self.manifest['models'][key]['fingerprint']
+
+    def check_sources(self, model_path):
+        """
+        Checks that the bundle was converted from the pickles in model_path.
+        A pickle is only hashed if its size or modification time differ
+        from the manifest.
+
+        Raises:
+            ValueError: if a pickle changed since the conversion
+        """
+        for key, entry in self.manifest['models'].items():
+            source = os.path.join(model_path, entry['source'])
+            if not os.path.isfile(source):
+                continue
+            stat = _stat(source)
+            if all(entry.get(name) == value for name, value in stat.items()):
+                continue
+            if _sha256(source) != entry['source_sha256']:
+                raise ValueError(f'Model bundle {self.path} is older than {source}. '
+                                 'Run modelbundle.py again.')
+
+    def load(self, key):
+        """
+        Loads a model. The preprocessing arrays are memory-mapped read-only,
+        so their pages are shared by all processes using the bundle.
+
+        Args:
+            key (str): '{direction}{horizon}', e.g. 'East5'
+
+        Returns:
+            FastPipeline: the model
+        """
+        entry = self.manifest['models'][key]
+
+        def array(name):
+            return np.load(os.path.join(self.path, entry['arrays'][name]), mmap_mode='r')
+
+        booster = xgb.Booster()
+        booster.load_model(os.path.join(self.path, entry['booster']))
+
+        return FastPipeline(
+            num_columns=entry['num_columns'],
+            medians=array('medians'),
+            means=array('means'),
+            scales=array('scales'),
+            cat_columns=entry['cat_columns'],
+            categories=[array(f'categories_{i}') for i in range(len(entry['cat_columns']))],
+            blocks=entry['blocks'],
+            booster=booster,
+            iteration_range=entry['iteration_range'],
+            missing=float(entry['missing']))
+
+
+def convert_pickles(model_path, bundle_path):
+    """
+    Converts the pickled Pipelines into a bundle
+
+    Args:
+        model_path (str): directory with the model_*.pkl files
+        bundle_path (str): output directory. The manifest is written last,
+                           so an interrupted conversion leaves no bundle.
+
+    Returns:
+        ModelBundle: the written bundle
+    """
+    os.makedirs(bundle_path, exist_ok=True)
+    manifest_path = os.path.join(bundle_path, MANIFEST)
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+    models = {}
+    for key, file_name in model_keys().items():
+        source = os.path.join(model_path, file_name)
+        pipeline = joblib.load(source)
+        fast = export_fast_pipeline(pipeline)
+
+        arrays = {'medians': fast.medians, 'means': fast.means, 'scales': fast.scales}
+        for i, categories in enumerate(fast.categories):
+            arrays[f'categories_{i}'] = categories
+        for name, values in arrays.items():
+            if values.dtype == object:
+                raise ValueError(f'{source}: only numeric {name} can be stored in a bundle')
+            np.save(os.path.join(bundle_path, f'{key}.{name}.npy'), np.ascontiguousarray(values))
+        fast.booster.save_model(os.path.join(bundle_path, f'{key}.ubj'))
+
+        models[key] = {
+            'source': file_name,
+            'source_sha256': _sha256(source),
+            **_stat(source),
+            'fingerprint': joblib.hash(pipeline[:-1]),
+            'booster': f'{key}.ubj',
+            'arrays': {name: f'{key}.{name}.npy' for name in arrays},
+            'num_columns': fast.num_columns,
+            'cat_columns': fast.cat_columns,
+            'blocks': fast.blocks,
+            'iteration_range': list(fast.iteration_range),
+            'missing': repr(float(fast.missing)),
+        }
+
+    manifest = {
+        'format': BUNDLE_FORMAT,
+        'version': BUNDLE_VERSION,
+        'xgboost': xgb.__version__,
+        'models': models,
+    }
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    return ModelBundle(bundle_path)
+
+
+if __name__ == '__main__':
+    model_path = sys.argv[1] if len(sys.argv) > 1 else './models/'
+    bundle_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(model_path, 'bundle')
+    bundle = convert_pickles(model_path, bundle_path)
+    print(f'Converted {len(bundle.keys())} models to {bundle_path}')
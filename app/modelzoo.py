@@ -1,10 +1,19 @@
 from doctest import OutputChecker
 import os
+import threading
 import joblib
 from getrawdata import *
 from processdata import *
+from fastmodel import export_fast_pipeline
+from modelbundle import LazyDict, ModelBundle, model_keys
+from speedstate import SpeedState
+from resultcache import ResultCache
+from statuswatcher import StatusWatcher
+from serialize import render_arrow, render_csv, render_json_body
+from metrics import METRICS
 import yaml
 from json import dumps
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime, timezone, timedelta
 
 
@@ -28,6 +37,22 @@ class ModelZoo:
         
         self.tmcs_all_dict = read_all_tmcs(data_path=self.DATA_PATH)
         self.target_tmcs_df_dict = read_target_tmcs(data_path=self.DATA_PATH)
+        self.speed_states = {
+            direction: SpeedState(self.tmcs_all_dict[direction])
+            for direction in ['East', 'West']
+        }
+        self.result_cache = ResultCache(self.RESULT_CACHE_SIZE)
+        self.status_watcher = StatusWatcher(self.bb_endpoint, self.token,
+                                            min_interval = self.STATUS_POLL_INTERVAL)
+        # Last computed entry per direction, horizons, read_config and lanes
+        # status, returned when an estimate misses its deadline
+        self.last_good = {}
+        # Computations started by deadline-bounded estimates, which go on
+        # in the background after the deadline
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.refresh_executor = ThreadPoolExecutor(max_workers = 4,
+                                                   thread_name_prefix = 'refresh')
         
         self.load_model_dict()
 
@@ -37,23 +62,98 @@ class ModelZoo:
         
         self.TOKEN_FILE = config['CREDENTIALS']['TOKEN_FILE']
         self.MODEL_PATH = config['SETTINGS']['MODEL_PATH']
+        self.MODEL_BUNDLE = config['SETTINGS']['MODEL_BUNDLE']
+        self.LAZY_LOADING = config['SETTINGS']['LAZY_LOADING']
         self.DATA_PATH = config['SETTINGS']['DATA_PATH']
         self.LINETERMINATOR = config['SETTINGS']['LINETERMINATOR']
         self.VERSION = config['GENERAL']['VERSION']
+        self.FAST_INFERENCE = config['SETTINGS']['FAST_INFERENCE']
+        self.ROLLING_STATE = config['SETTINGS']['ROLLING_STATE']
+        self.RESULT_CACHE_SIZE = config['SETTINGS']['RESULT_CACHE_SIZE']
+        self.STATUS_POLL_INTERVAL = config['SETTINGS']['STATUS_POLL_INTERVAL']
+        self.ARCHIVE_PATH = config['SETTINGS']['ARCHIVE_PATH']
+        self.SPEED_WINDOW = config['SETTINGS']['SPEED_WINDOW']
+        self.METRICS = config['SETTINGS']['METRICS']
+        self.DEADLINE = config['SETTINGS']['DEADLINE']
+        self.PRECOMPUTE = config['SETTINGS']['PRECOMPUTE']
+        self.PRECOMPUTE_OFFSET = config['SETTINGS']['PRECOMPUTE_OFFSET']
+        METRICS.enabled = self.METRICS
+
+        configure_http(
+            connect_timeout=config['HTTP']['CONNECT_TIMEOUT'],
+            read_timeout=config['HTTP']['READ_TIMEOUT'],
+            retries=config['HTTP']['RETRIES'],
+            backoff_factor=config['HTTP']['BACKOFF_FACTOR'],
+            pool_maxsize=config['HTTP']['POOL_MAXSIZE'])
+        configure_archive(self.ARCHIVE_PATH)
                 
                         
     def load_model_dict(self):
-        self.model_dict = {}
-        for direction in ['East', 'West']:
-            for forecast_horizon in range(5, 31, 5):
-                model_path = os.path.join(self.MODEL_PATH, f'model_{direction}_{forecast_horizon}_min.pkl')
-                self.model_dict[f'{direction}{forecast_horizon}'] = joblib.load(model_path)
+        # Models are loaded on first use: the pickled pipelines (model_dict)
+        # from MODEL_PATH, the FastPipelines from MODEL_BUNDLE if it exists
+        keys = model_keys()
+        self.model_dict = LazyDict(keys, lambda key: joblib.load(
+            os.path.join(self.MODEL_PATH, keys[key])))
+
+        if ModelBundle.exists(self.MODEL_BUNDLE):
+            bundle = ModelBundle(self.MODEL_BUNDLE)
+            bundle.check_sources(self.MODEL_PATH)
+            self.preprocessor_dict = {key: bundle.fingerprint(key) for key in keys}
+            self.fast_model_dict = LazyDict(keys, bundle.load)
+        else:
+            # Fitted preprocessing steps are hashed, so that horizons
+            # trained with the same preprocessing can share one transform
+            self.preprocessor_dict = LazyDict(keys, lambda key: joblib.hash(self.model_dict[key][:-1]))
+            self.fast_model_dict = LazyDict(keys, lambda key: export_fast_pipeline(self.model_dict[key]))
+
+        if not self.LAZY_LOADING:
+            self.preload_models()
+
+    def preload_models(self):
+        """
+        Loads all the models used for estimates. Called before forking
+        service workers, so that the workers share the loaded models.
+        """
+        for key in self.preprocessor_dict:
+            self.preprocessor_dict[key]
+            if self.FAST_INFERENCE:
+                self.fast_model_dict[key]
+            else:
+                self.model_dict[key]
                 
                 
                 
+    def get_speeds(self, direction, asof = None):
+        """
+        Gets 5 minute speeds for the direction. With ROLLING_STATE, the pull
+        is merged into the direction's SpeedState and only the latest
+        interval and its lags are returned.
+
+        Args:
+            direction (string): Traffic direction (East/West)
+            asof (datetime, optional): Timestamp of the current situation,
+                                       for speed endpoint.
+        Returns:
+            pd.DataFrame: 5 minute speeds, as returned by agg_speed_5m
+        """
+        raw = get_speed_data(
+            self.tmcs_all_dict[direction],
+            speed_endpoint=self.speed_endpoint,
+            asof = asof,
+            token=self.token)
+
+        with METRICS.timer('agg_speed_5m'):
+            if self.ROLLING_STATE:
+                speeds = self.speed_states[direction].update(raw)
+            else:
+                speeds = agg_speed_5m(raw)
+        METRICS.count('agg_speed_5m', len(speeds))
+        return speeds
+
     def get_data_now(self, direction, 
                      asof = None,
-                     read_config = False):
+                     read_config = False,
+                     expand = True):
         """
         Prepares data for the model
 
@@ -64,57 +164,83 @@ class ModelZoo:
             read_config (bool, optional): If True, the curent
                 configuration of BB is read and used. Otherwise uses all
                 configurations.
+            expand (bool, optional): If False, the data are not replicated
+                for each BB configuration (see estimate configurations).
         Returns:
             pd.DataFrame: The ML data for the model
-        """ 
-  
-  
+        """
+
+        lane_data = self.get_lane_data(read_config)
+        speeds = self.get_speeds(direction, asof = asof)
+
+        return self.build_ml_data(direction, speeds, lane_data, read_config,
+                                  expand = expand)
+
+    def get_lane_data(self, read_config = False):
+        """
+        Gets the lane configuration data
+
+        Args:
+            read_config (bool, optional): If True, the curent configuration
+                of BB is read from the status endpoint (through the status
+                watcher, at most every STATUS_POLL_INTERVAL seconds).
+                Otherwise the base status is used.
+        Returns:
+            pd.DataFrame: lane data, as returned by get_bb_current_status_df
+        """
         if read_config:
-            lane_data = get_bb_current_status_df(get_bb_data(bb_endpoint = self.bb_endpoint,
-                                                 token = self.token))
+            _, lane_df = self.status_watcher.get()
+            lane_data = lane_df.assign(measurement_tstamp = datetime.now(timezone.utc))
         else:
             lane_data = get_bb_base_status_df()
-            
+
         lane_data.measurement_tstamp = lane_data.measurement_tstamp.dt.floor("5min")
-            
-        speeds = agg_speed_5m(get_speed_data(
-            self.tmcs_all_dict[direction],
-            speed_endpoint=self.speed_endpoint,
-            asof = asof,
-            token=self.token))
-
-        queue_data = generate_queue_data(speeds, self.target_tmcs_df_dict[direction])
-        ml_data = prepare_ml_data(
-            tmc_list = self.tmcs_all_dict[direction], 
-            tmc_target = self.target_tmcs_df_dict[direction],
-            speeds = speeds,
-            lane_data = lane_data, 
-            queue_data = queue_data
-        )
+        return lane_data
+
+    def build_ml_data(self, direction, speeds, lane_data, read_config = False,
+                      expand = True):
+        """
+        Prepares data for the model from already fetched speeds and lane data
+
+        Args:
+            direction (string): Traffic direction (East/West)
+            speeds (pd.DataFrame): 5 minute speeds, as returned by get_speeds
+            lane_data (pd.DataFrame): lane data, as returned by get_lane_data.
+                                      It is not modified.
+            read_config (bool, optional): If False, data for all the BB
+                configurations are returned.
+            expand (bool, optional): If False, the data are not replicated
+                for each BB configuration (see estimate configurations).
+        Returns:
+            pd.DataFrame: The ML data for the model
+        """
+        # Features are computed only for the latest timestamp
+        timestamps = [speeds.measurement_tstamp.max()]
+        with METRICS.timer('generate_queue_data'):
+            queue_data = generate_queue_data(speeds, self.target_tmcs_df_dict[direction],
+                                             timestamps = timestamps)
+        with METRICS.timer('prepare_ml_data'):
+            ml_data = prepare_ml_data(
+                tmc_list = self.tmcs_all_dict[direction], 
+                tmc_target = self.target_tmcs_df_dict[direction],
+                speeds = speeds,
+                lane_data = lane_data, 
+                queue_data = queue_data,
+                timestamps = timestamps
+            )
         
         ml_data = ml_data[ml_data.measurement_tstamp == ml_data.measurement_tstamp.max()]
+        METRICS.count('prepare_ml_data', len(ml_data), ml_data.shape[1])
 
-        if read_config:
+        if read_config or not expand:
             return ml_data
         
         # Returns all the BB configurations data
-        
-        ret = pd.DataFrame()
-        for east in range (1, 5):
-            for west in range (1, 6-east):
-                ml_data.East = east
-                ml_data.West = west
-                if len(ret) == 0:
-                    ret = ml_data.copy()
-                else:
-                    ret = pd.concat([ret, ml_data],ignore_index=True)
-        return ret
-             
-                
-        return ml_data
+        with METRICS.timer('expand_configurations'):
+            return expand_configurations(ml_data, LANE_CONFIGURATIONS)
     
     def estimate_now(self, direction, forecast_horizon, 
-                     read_config=False, outputformat = 'json'):
+                     read_config=False, outputformat = 'json', deadline = None):
         """
         Provides estimates for current situation
             direction (string): Traffic direction (East/West)
@@ -123,6 +249,9 @@ class ModelZoo:
             read_config (bool, optional): If True, the curent
                 configuration of BB is read and used. Otherwise uses all
                 configurations.
+            deadline (float, optional): latency budget [s]. If the estimate
+                takes longer, the last good one is returned (see
+                get_entry_within). None waits for the estimate.
         Returns:
             pd.DataFrame: A dataframe with results. The columsn are 
             ['horizon', 'tmc_code', 'measurement_tstamp', 'sr', 
@@ -130,32 +259,330 @@ class ModelZoo:
         """
         
         timestamp = datetime.now(timezone.utc)
-                
-        ml_data = self.get_data_now(
-            direction=direction, 
-            asof = timestamp,
-            read_config=read_config)
-        
-        
-        
-        res_df = self.estimate(ml_data, direction, forecast_horizon)
-        
-        
-        if outputformat == 'df':
-            return res_df
-        if outputformat == 'csv':
-            return res_df.to_csv(index=False, line_terminator=self.LINETERMINATOR)
+
+        with METRICS.timer('estimate_now', direction = direction):
+            if deadline is None:
+                entry = self.get_entry(direction, forecast_horizon, read_config, timestamp)
+            else:
+                entry = self.get_entry_within(deadline, direction, forecast_horizon,
+                                              read_config, timestamp)
+
+            return self.render_entry(entry, direction, forecast_horizon,
+                                     timestamp, outputformat)
+
+    def get_entry(self, direction, forecast_horizon, read_config, timestamp):
+        """
+        Returns the result cache entry of the estimates, computing it if it
+        is not cached (see compute_entry)
+        """
+        lane_data = self.get_lane_data(read_config)
+        key = self.get_cache_key(direction, forecast_horizon, read_config,
+                                 lane_data, timestamp)
+        entry = self.result_cache.get(key, timestamp)
+        if entry is None:
+            speeds = self.get_speeds(direction, asof = timestamp)
+            entry = self.compute_entry(key, direction, forecast_horizon, read_config,
+                                       speeds, lane_data, timestamp)
+        return entry
+
+    def get_entry_within(self, deadline, direction, forecast_horizon, read_config,
+                         timestamp):
+        """
+        Returns get_entry if it completes within deadline seconds. Otherwise
+        returns the last good entry of the same direction, horizons,
+        read_config and lanes status, flagged stale, while the computation
+        completes in the background and fills the result cache. Requests
+        of the same estimate share one computation. Without a last good
+        entry, waits for the computation.
+
+        Returns:
+            dict: cache entry (see compute_entry), with stale = True if it
+                  is the last good one
+        """
+        pending_key = (direction, self.__get_bucket(timestamp), str(forecast_horizon),
+                       read_config)
+        with self.pending_lock:
+            future = self.pending.get(pending_key)
+            if future is None:
+                future = self.refresh_executor.submit(
+                    self.get_entry, direction, forecast_horizon, read_config, timestamp)
+                self.pending[pending_key] = future
+                future.add_done_callback(
+                    lambda f: self.pending.pop(pending_key, None))
+        try:
+            return future.result(timeout = deadline)
+        except FutureTimeoutError:
+            pass
+
+        entry = self.get_last_good(direction, forecast_horizon, read_config, timestamp)
+        if entry is None:
+            return future.result()
+        METRICS.count('stale', 1, direction = direction)
+        return dict(entry, stale = True)
+
+    def get_last_good(self, direction, forecast_horizon, read_config, timestamp):
+        """
+        Returns the last computed entry of the direction, horizons,
+        read_config and current lanes status (the last one the status watcher
+        saw, without requesting it), None if there is none
+        """
+        if read_config:
+            lane_data = self.status_watcher.lane_df
+            if lane_data is None:
+                return None
+        else:
+            lane_data = get_bb_base_status_df()
+        key = self.get_cache_key(direction, forecast_horizon, read_config,
+                                 lane_data, timestamp)
+        return self.last_good.get(key[:1] + key[2:])
+
+    def get_cache_key(self, direction, forecast_horizon, read_config,
+                      lane_data, timestamp):
+        """
+        Returns the result cache key: direction, 5 minute bucket of the
+        timestamp, horizons, read_config and a fingerprint of the lanes status
+        """
+        if forecast_horizon == 'all':
+            horizons = (5, 10, 15, 20, 25, 30)
+        elif isinstance(forecast_horizon, (int, str)):
+            horizons = (int(forecast_horizon), )
+        else:
+            horizons = tuple(int(x) for x in forecast_horizon)
+        lanes = joblib.hash(lane_data.drop(columns='measurement_tstamp'))
+        return (direction, self.__get_bucket(timestamp), horizons, read_config, lanes)
+
+    def compute_entry(self, key, direction, forecast_horizon, read_config,
+                      speeds, lane_data, timestamp):
+        """
+        Computes estimates and stores them in the result cache until the end
+        of the 5 minute bucket of the timestamp
+
+        Returns:
+            dict: cache entry with res_df (as returned by estimate), asof
+                  (timestamp of the speed data) and renderings (json/csv
+                  outputs, filled by render_entry)
+        """
+        ml_data = self.build_ml_data(direction, speeds, lane_data,
+                                     read_config = read_config,
+                                     expand = False)
+        configurations = None if read_config else LANE_CONFIGURATIONS
+        res_df = self.estimate(ml_data, direction, forecast_horizon,
+                               configurations=configurations)
+
+        entry = {'res_df': res_df, 'asof': timestamp, 'renderings': {}}
+        expires = self.__get_bucket(timestamp) + timedelta(minutes=5)
+        self.result_cache.put(key, entry, expires, timestamp)
+        # Kept without its bucket, for get_last_good
+        self.last_good[key[:1] + key[2:]] = entry
+        return entry
+
+    def render_entry(self, entry, direction, forecast_horizon, timestamp,
+                     outputformat = 'json'):
+        """
+        Returns a cache entry in the output format. The json predictions, the
+        csv and the arrow stream are rendered once per entry, the json header
+        for each request.
+        """
+        res_df = entry['res_df']
+        renderings = entry['renderings']
+        if outputformat == 'arrow':
+            if 'arrow' not in renderings:
+                with METRICS.timer('render_arrow'):
+                    renderings['arrow'] = render_arrow(res_df)
+            return renderings['arrow']
+        elif outputformat == 'csv':
+            if 'csv' not in renderings:
+                with METRICS.timer('render_csv'):
+                    renderings['csv'] = render_csv(res_df, self.LINETERMINATOR)
+            return renderings['csv']
         elif outputformat == 'json':
-            dic = {}
-            dic['header'] = self.get_json_header_dic(direction, forecast_horizon, timestamp)
-            dic['predictions'] = self.get_json_body_dic(res_df)
-            return dumps(dic)
+            if 'json' not in renderings:
+                with METRICS.timer('render_json'):
+                    renderings['json'] = render_json_body(res_df)
+            stale = entry.get('stale', False)
+            header = self.get_json_header_dic(
+                direction, forecast_horizon, timestamp, asOf = entry['asof'],
+                measurement_tstamp = self.__get_bucket(entry['asof']) if stale else None,
+                stale = stale)
+            # Same as dumps({'header': header, 'predictions': predictions})
+            return '{"header": ' + dumps(header) + ', "predictions": ' + renderings['json'] + '}'
         else:
-            return res_df            
-                    
-        
-    
-    def estimate(self, ml_data, direction, forecast_horizon='all'):
+            return res_df.copy()
+
+    def estimate_all_directions(self, forecast_horizon,
+                                read_config=False, outputformat = 'json',
+                                deadline = None):
+        """
+        Provides estimates for current situation in both directions. East
+        speeds, West speeds and (with read_config) the BB status are
+        requested concurrently, the single status response is used for both
+        directions, and the directions' features and estimates are computed
+        in parallel. Results are taken from the result cache when possible;
+        without read_config the speeds of cached directions are not requested.
+        Args:
+            forecast_horizon: Forecast horizon[s] in minutes. Could be an int,
+                                    a list of integers or a string 'all'
+            read_config (bool, optional): If True, the curent
+                configuration of BB is read and used. Otherwise uses all
+                configurations.
+            outputformat (string): json, csv, arrow or df
+            deadline (float, optional): latency budget [s] of each direction,
+                see estimate_now. The directions are then computed separately.
+        Returns:
+            json: {direction: estimate_now json output of the direction}
+            csv/arrow/pd.DataFrame: results of both directions, as returned
+                by estimate, with an additional first column 'direction'
+        """
+
+        timestamp = datetime.now(timezone.utc)
+        directions = ['East', 'West']
+
+        if deadline is None:
+            entries = self.get_entries(directions, forecast_horizon, read_config, timestamp)
+        else:
+            # Each direction within the deadline, in parallel
+            with ThreadPoolExecutor(max_workers=len(directions)) as executor:
+                entries = dict(zip(directions, executor.map(
+                    lambda direction: self.get_entry_within(deadline, direction, forecast_horizon,
+                                                            read_config, timestamp),
+                    directions)))
+
+        if outputformat == 'json':
+            # Same as dumps({direction: estimate_now json output})
+            return '{' + ', '.join(
+                dumps(direction) + ': ' + self.render_entry(entries[direction], direction,
+                                                            forecast_horizon, timestamp)
+                for direction in directions) + '}'
+
+        res_df = pd.concat([
+            entries[direction]['res_df'].assign(direction=direction)
+            for direction in directions
+        ], ignore_index=True)
+        res_df = res_df[['direction'] + [c for c in res_df.columns if c != 'direction']]
+        if outputformat == 'csv':
+            return render_csv(res_df, self.LINETERMINATOR)
+        if outputformat == 'arrow':
+            return render_arrow(res_df)
+        return res_df
+
+    def get_entries(self, directions, forecast_horizon, read_config, timestamp):
+        """
+        Returns the result cache entries of the directions, as get_entry,
+        with the requests and computations of the directions in parallel
+
+        Returns:
+            dict: {direction: cache entry}
+        """
+        with ThreadPoolExecutor(max_workers=len(directions) + 1) as executor:
+            lane_future = executor.submit(self.get_lane_data, read_config)
+            speed_futures = {}
+            if read_config:
+                # The cache key needs the status, so the speeds are
+                # requested while waiting for it
+                speed_futures = {
+                    direction: executor.submit(self.get_speeds, direction, asof = timestamp)
+                    for direction in directions
+                }
+            lane_data = lane_future.result()
+
+            keys, entries = {}, {}
+            for direction in directions:
+                keys[direction] = self.get_cache_key(direction, forecast_horizon, read_config,
+                                                     lane_data, timestamp)
+                entries[direction] = self.result_cache.get(keys[direction], timestamp)
+                if entries[direction] is None and direction not in speed_futures:
+                    speed_futures[direction] = executor.submit(
+                        self.get_speeds, direction, asof = timestamp)
+
+            def run(direction):
+                if entries[direction] is not None:
+                    return entries[direction]
+                return self.compute_entry(
+                    keys[direction], direction, forecast_horizon, read_config,
+                    speeds = speed_futures[direction].result(),
+                    lane_data = lane_data,
+                    timestamp = timestamp)
+
+            return dict(zip(directions, executor.map(run, directions)))
+
+    def estimate_batch(self, direction, asof_list, horizons = 'all',
+                       outputformat = 'df'):
+        """
+        Provides estimates for many past instants at once, for all BB
+        configurations. The speeds covering all the instants and their lags
+        are read once: from the archive if ARCHIVE_PATH is set, otherwise
+        from the endpoint, with one request per SPEED_WINDOW minutes of the
+        instants and their lags (get_speed_data_ranges). The features of all
+        instants are built in a single pass and each horizon model runs once
+        on the stacked rows.
+
+        Instants are floored to their 5 minute interval, aggregated over all
+        the records read, so an instant inside an interval sees it complete
+        (backtest.py replays the partial intervals estimate_now saw).
+
+        Args:
+            direction (string): Traffic direction (East/West)
+            asof_list (list): instants (datetime, UTC if naive)
+            horizons: Forecast horizon[s] in minutes. Could be an int,
+                      a list of integers or a string 'all'
+            outputformat (string): df, csv, arrow or json
+        Returns:
+            pd.DataFrame/csv/arrow: long format estimates, as returned by estimate,
+                with the additional first column 'asof' (the instant).
+                Instants without speeds have no rows.
+            json: {asof: predictions of the instant, as in the estimate_now
+                json output}
+        """
+        asofs = pd.DatetimeIndex(pd.to_datetime(asof_list, utc = True)).unique().sort_values()
+        if len(asofs) == 0:
+            raise ValueError('asof_list is empty')
+        buckets = asofs.floor('5min')
+        tmc_list = self.tmcs_all_dict[direction]
+        tmc_target = self.target_tmcs_df_dict[direction]
+
+        with METRICS.timer('estimate_batch', direction = direction):
+            if self.ARCHIVE_PATH is not None:
+                raw = get_archived_speed_data(tmc_list,
+                                              buckets[0] - timedelta(minutes = max(LAGS)),
+                                              asofs[-1])
+            else:
+                lag = timedelta(minutes = max(LAGS))
+                ranges = [((bucket - lag).to_pydatetime(), asof.to_pydatetime())
+                          for bucket, asof in zip(buckets, asofs)]
+                raw = get_speed_data_ranges(tmc_list, ranges,
+                                            window = self.SPEED_WINDOW,
+                                            speed_endpoint = self.speed_endpoint,
+                                            token = self.token)
+            speeds = agg_speed_5m(raw)
+
+            targets = list(buckets.unique())
+            with METRICS.timer('generate_queue_data'):
+                queue_data = generate_queue_data(speeds, tmc_target, timestamps = targets)
+            with METRICS.timer('prepare_ml_data'):
+                # Lanes are replaced by each configuration in estimate
+                ml_data = prepare_ml_data(tmc_list, tmc_target, speeds,
+                                          get_bb_base_status_df(), queue_data,
+                                          timestamps = targets)
+            METRICS.count('prepare_ml_data', len(ml_data), ml_data.shape[1])
+            res_df = self.estimate(ml_data, direction, horizons,
+                                   configurations = LANE_CONFIGURATIONS)
+
+            # Instants of the same interval share its estimates
+            res_df = pd.DataFrame({'asof': asofs, 'measurement_tstamp': buckets}).merge(
+                res_df, on = 'measurement_tstamp')
+
+        if outputformat == 'json':
+            return '{' + ', '.join(
+                dumps(asof.isoformat()) + ': ' + render_json_body(group)
+                for asof, group in res_df.groupby('asof', sort = True)) + '}'
+        if outputformat == 'csv':
+            return render_csv(res_df, self.LINETERMINATOR)
+        if outputformat == 'arrow':
+            return render_arrow(res_df)
+        return res_df
+
+    def estimate(self, ml_data, direction, forecast_horizon='all',
+                 configurations=None):
         """
         Provides estimates for current situation
         Args:
@@ -163,6 +590,10 @@ class ModelZoo:
             direction (string): Traffic direction (East/West)
             forecast_horizon: Forecast horizon[s] in minutes. Could be an int,
                               a list of integers or a string 'all'
+            configurations (pd.DataFrame, optional): BB configurations
+                (East, West). If given, ml_data is estimated for each
+                configuration, as if it was expand_configurations(ml_data),
+                but the features are transformed only once.
         Returns:
             pd.DataFrame/csv/json with restuls.
             If it is a dataframe or a csv,  The columsn are 
@@ -175,13 +606,40 @@ class ModelZoo:
         elif isinstance(forecast_horizon, (int, str)):
             forecast_horizon = [forecast_horizon]
 
-        res_df = pd.DataFrame()        
-        for horizon in forecast_horizon:                
-            model = self.model_dict[f'{direction}{horizon}']
-            pred = model.predict(ml_data)
+        res_cols = ['tmc_code', 'measurement_tstamp', 'West', 'East', 'reference_speed']
+        res_df = pd.DataFrame()
+        transformed = {}
+        for horizon in forecast_horizon:
+            # The feature frame is transformed once per distinct preprocessor
+            # and the result is fed to each horizon's regressor
+            preprocessor = self.preprocessor_dict[f'{direction}{horizon}']
+            if self.FAST_INFERENCE:
+                model = self.fast_model_dict[f'{direction}{horizon}']
+                with METRICS.timer('transform', horizon = horizon):
+                    if preprocessor not in transformed and configurations is not None:
+                        # Only the East/West columns differ between configurations
+                        transformed[preprocessor] = model.transform_configurations(
+                            ml_data, configurations)
+                    elif preprocessor not in transformed:
+                        transformed[preprocessor] = model.transform(ml_data)
+                with METRICS.timer('predict', horizon = horizon):
+                    pred = model.predict_transformed(transformed[preprocessor])
+            else:
+                model = self.model_dict[f'{direction}{horizon}']
+                with METRICS.timer('transform', horizon = horizon):
+                    if preprocessor not in transformed and configurations is not None:
+                        transformed[preprocessor] = model[:-1].transform(
+                            expand_configurations(ml_data, configurations))
+                    elif preprocessor not in transformed:
+                        transformed[preprocessor] = model[:-1].transform(ml_data)
+                with METRICS.timer('predict', horizon = horizon):
+                    pred = model[-1].predict(transformed[preprocessor])
+            METRICS.count('predict', len(pred), transformed[preprocessor].shape[1],
+                          horizon = horizon)
             
-            if len (res_df) == 0:
-                res_cols = ['tmc_code', 'measurement_tstamp', 'West', 'East', 'reference_speed']
+            if len (res_df) == 0 and configurations is not None:
+                res_df = expand_configurations(ml_data[res_cols], configurations)
+            elif len (res_df) == 0:
                 res_df = ml_data[res_cols].copy()       
                 
             res_df[f'sr_pred_{horizon}'] = pred
@@ -190,11 +648,18 @@ class ModelZoo:
     
     def __get_date_str(self, dt):
         return dt.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+
+    def __get_bucket(self, dt):
+        # Start of the 5 minute interval of dt
+        return dt - timedelta(minutes=dt.minute % 5,
+                              seconds=dt.second,
+                              microseconds=dt.microsecond)
     
     def get_json_header_dic(self, direction, forecast_horizon, 
                             timestamp = None,
                             asOf = None, 
-                            measurement_tstamp = None):
+                            measurement_tstamp = None,
+                            stale = False):
         """Provives a dictionary for json output header
         Args:
             direction: traffic direction [East/West]
@@ -205,6 +670,9 @@ class ModelZoo:
                   used
             measurement_tstamp: measurement timestamp (5 minute interval). 
                                 If None, computed automatically from timestamp
+            stale: True if the predictions are the last good ones, returned
+                   because the estimate missed its deadline. Only then
+                   the header has a 'stale' field.
 
         Returns:
             _type_: _description_
@@ -216,9 +684,7 @@ class ModelZoo:
         if asOf is None:
             asOf = timestamp
         if measurement_tstamp is None:          
-            measurement_tstamp = timestamp - timedelta(minutes=timestamp.minute % 5,
-                                                       seconds=timestamp.second,
-                                                       microseconds=timestamp.microsecond)
+            measurement_tstamp = self.__get_bucket(timestamp)
             
         
         header = {
@@ -231,8 +697,11 @@ class ModelZoo:
                 }
             },
             'measurement_tstamp' : self.__get_date_str(measurement_tstamp),
-            'version' : self.VERSION
         }
+        # Only fallback answers carry the flag, fresh headers are unchanged
+        if stale:
+            header['stale'] = True
+        header['version'] = self.VERSION
         
         return header
     
@@ -1,65 +1,178 @@
 # Script used for processing data
+import numpy as np
 import pandas as pd
 from datetime import timedelta
 
 
-def generate_queue_data(df, link):
+LAGS = [5, 10, 15, 20, 25, 30]
+QUEUE_LABELS = ['zero', 'one', 'more_than_one']
+
+# Valid BB lane configurations (5 lanes, at least one in each direction)
+LANE_CONFIGURATIONS = pd.DataFrame(
+    [(east, west) for east in range(1, 5) for west in range(1, 6 - east)],
+    columns=['East', 'West']).astype(np.int8)
+
+
+def _lookup(keys, index, values):
+    """
+    Looks up values by key, as a left merge on a unique key would
+    Args:
+        keys (array-like): looked up keys
+        index (pd.Index): unique keys of values
+        values (array-like): values
+    Returns:
+        np.ndarray: values of the keys, NaN (and the dtype a merge would
+                    give) where a key is missing
+    """
+    return pd.Series(np.asarray(values), index=index).reindex(keys).to_numpy()
+
+
+def _lag_index(times, lag):
+    """
+    Finds the position of (timestamp - lag) for each timestamp
+    Args:
+        times (np.ndarray): sorted, unique timestamps (datetime64)
+        lag (int): lag in minutes
+    Returns:
+        np.ndarray: positions in times, -1 where (timestamp - lag) is missing
+    """
+    shifted = times - np.timedelta64(lag, 'm')
+    idx = np.searchsorted(times, shifted)
+    found = times[np.minimum(idx, len(times) - 1)] == shifted
+    return np.where(found, idx, -1)
+
+
+def _lag_context(df, timestamps):
+    """
+    Restricts speeds to the timestamps needed to compute features for the
+    target timestamps, i.e. the targets and their 5-30 minute lags
+    Args:
+        df (pd.DataFrame): speeds
+        timestamps (list): target timestamps
+    Returns:
+        (pd.DataFrame, np.ndarray): restricted speeds and target timestamps
+                                    (datetime64)
+    """
+    targets = pd.DatetimeIndex(pd.to_datetime(timestamps))
+    context = targets
+    for lag in LAGS:
+        context = context.union(targets - timedelta(minutes=lag))
+    df = df[pd.DatetimeIndex(df['measurement_tstamp']).isin(context)]
+    return df, np.asarray(targets.values)
+
+
+def generate_queue_data(df, link, timestamps = None):
     """
     Generates queue data.
     Args:
         df (pd.DataFrame): speeds (read from bb API)
         link (pd.DataFrame): target tmcs
+        timestamps (list, optional): if given, queue data is computed only
+            for these timestamps, using just the 30 minutes of speeds
+            needed for their lags
 
     Returns:
         pd.DataFrame: queue lengths info 
     """
 
-    # STEP 1 - Calculate speed ratio.
-    df['speed_ratio']=df['speed']/df['reference_speed']
+    if timestamps is not None:
+        df, targets = _lag_context(df, timestamps)
+
+    # STEP 1 - Calculate speed ratio and put target tmcs, sorted by dist,
+    # on a (time x tmc) grid
+    link = link.sort_values(by=['dist'], kind='mergesort')
+    dist = link['dist'].to_numpy(dtype=np.float64)
+    length = link['length'].to_numpy(dtype=np.float64)
 
-    # Merging and sorting input data
-    df['measurement_tstamp']=pd.to_datetime(df['measurement_tstamp'])
-    df=link.merge(df[['tmc_code','measurement_tstamp','speed_ratio']],on=['tmc_code'])
-    df=df.sort_values(by=['dist'])    
+    k_codes = pd.Index(link['tmc_code']).get_indexer(df['tmc_code'])
+    rows = np.flatnonzero(k_codes >= 0)
+    k_codes = k_codes[rows]
+    speed_ratio = df['speed'].to_numpy()[rows] / df['reference_speed'].to_numpy()[rows]
+    t_codes, times = pd.factorize(
+        pd.to_datetime(df['measurement_tstamp'].iloc[rows]), sort=True)
+    n_times, n_tmcs = len(times), len(link)
 
     # STEP 2 - Determine the queue.
-    df['queue']=0
-    df.loc[df['speed_ratio']<0.6,'queue']=df.loc[df['speed_ratio']<0.6,'length']
-    
+    present = np.zeros((n_times, n_tmcs), dtype=bool)
+    present[t_codes, k_codes] = True
+    slow = np.zeros((n_times, n_tmcs), dtype=bool)
+    slow[t_codes, k_codes] = speed_ratio < 0.6
 
-    # STEP 3 - Calculate the queue length.
-    dq=df.groupby('measurement_tstamp')[['queue']].sum().reset_index()
-    
+    # STEP 3 - Calculate the queue length. Lengths are added along the road
+    # with the same compensated summation as pandas groupby().sum()
+    queue = np.zeros(n_times)
+    compensation = np.zeros(n_times)
+    for k in range(n_tmcs):
+        y = np.where(slow[:, k], length[k], 0.0) - compensation
+        t = queue + y
+        compensation = np.where(present[:, k], (t - queue) - y, compensation)
+        queue = np.where(present[:, k], t, queue)
 
     # STEP 4 - Reshape the table.
-    for lag in ([5,10,15,20,25,30]):
-        dq1=dq.copy()
-        dq1['measurement_tstamp'] += timedelta(hours=0, minutes=lag)
-        dq=dq.merge(dq1[['measurement_tstamp','queue']],on=['measurement_tstamp'],suffixes=['','_'+str(lag)], how = 'left')    
-
+    dq = pd.DataFrame({'measurement_tstamp': times})
 
+    # STEP 5 - Calculate the start and the end of the queue.
+    any_slow = slow.any(axis=1)
+    first = slow.argmax(axis=1)
+    last = n_tmcs - 1 - slow[:, ::-1].argmax(axis=1)
+    dq['dist_start'] = np.where(any_slow, dist[first] - length[first], np.nan)
+    dq['dist_end'] = np.where(any_slow, dist[last], np.nan)
 
+    dq['queue'] = queue
+    for lag in LAGS:
+        idx = _lag_index(np.asarray(times.values), lag)
+        dq[f'queue_{lag}'] = np.where(idx >= 0, queue[idx], np.nan)
 
-    # STEP 5 - Calculate the start and the end of the queue.
-    dq2=pd.merge(df.loc[df['speed_ratio']<0.6].drop_duplicates(subset=['measurement_tstamp'],keep='first')[['measurement_tstamp','dist','length']],
-             df.loc[df['speed_ratio']<0.6].drop_duplicates(subset=['measurement_tstamp'],keep='last')[['measurement_tstamp','dist','length']],
-             on='measurement_tstamp',suffixes=['_start','_end'])
-    dq2['dist_start']=dq2['dist_start']-dq2['length_start']
-    dq=dq2[['measurement_tstamp','dist_start','dist_end']].merge(dq,on='measurement_tstamp',how='right')
-    
     # STEP 6 - determine the number of queues
-    dq['num_queue']='zero'
-    dq.loc[(dq['queue']>0)&(dq['dist_end']-dq['dist_start']-dq['queue']<0.001),'num_queue']='one'
-    dq.loc[(dq['queue']>0)&(dq['dist_end']-dq['dist_start']-dq['queue']>0.001),'num_queue']='more_than_one'
+    spread = dq['dist_end'].to_numpy() - dq['dist_start'].to_numpy() - queue
+    num_queue = np.zeros(n_times, dtype=np.int8)
+    num_queue[(queue > 0) & (spread < 0.001)] = 1
+    num_queue[(queue > 0) & (spread > 0.001)] = 2
+    dq['num_queue'] = pd.Categorical.from_codes(num_queue, QUEUE_LABELS)
     
     # STEP 7 (optional) - drop rows with nans
-    queue_cols = [f'queue_{x}' for x in range (5, 31, 5)]
+    queue_cols = [f'queue_{x}' for x in LAGS]
     dq.dropna(axis = 0, how = 'any', subset=queue_cols, inplace = True)
 
+    if timestamps is not None:
+        dq = dq[np.isin(np.asarray(dq['measurement_tstamp'].values), targets)]
+
 
     return dq
 
-def prepare_ml_data(tmc_list, tmc_target, speeds, lane_data, queue_data):
+def iter_queue_data(chunks, link):
+    """
+    Generates queue data for speeds delivered in time chunks (e.g. one day
+    at a time), so that long histories are processed with bounded memory.
+    The last 30 minutes of each chunk are carried over to the next one for
+    the lags.
+    Args:
+        chunks (iterable): speed DataFrames, in time order
+        link (pd.DataFrame): target tmcs
+
+    Yields:
+        pd.DataFrame: queue lengths info for the timestamps of each chunk
+    """
+    cols = ['tmc_code', 'measurement_tstamp', 'speed', 'reference_speed']
+    carry = None
+    for chunk in chunks:
+        chunk = chunk.loc[chunk['tmc_code'].isin(link['tmc_code']), cols]
+        chunk = chunk.assign(measurement_tstamp=pd.to_datetime(chunk['measurement_tstamp']))
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            continue
+
+        dq = generate_queue_data(chunk, link)
+        if carry is not None and len(carry) > 0:
+            dq = dq[dq['measurement_tstamp'] > carry['measurement_tstamp'].max()]
+        yield dq
+
+        cutoff = chunk['measurement_tstamp'].max() - timedelta(minutes=max(LAGS))
+        carry = chunk[chunk['measurement_tstamp'] >= cutoff]
+
+def prepare_ml_data(tmc_list, tmc_target, speeds, lane_data, queue_data,
+                    timestamps = None, dtype = np.float64):
     """
     Prepares data for machine learning
     Arguments:
@@ -69,62 +182,104 @@ def prepare_ml_data(tmc_list, tmc_target, speeds, lane_data, queue_data):
                      tmc/timestamp
         lane_data  - lane data, output from generate_bb_data() function
         queue_data - queue data, output from generate_queue_data() function
+        timestamps - (optional) list of target timestamps. If given, rows
+                     are produced only for these timestamps, using just the
+                     30 minutes of speeds needed for their lags
+        dtype      - (optional) dtype of the speed ratio features. float32
+                     halves the memory of long windows (e.g. for training),
+                     float64 gives the features the models were fitted on.
     Returns:
-        A dataframe prepared for Machnie Learning.
+        A dataframe prepared for Machnie Learning. The inputs are not
+        modified. tmc_code is categorical, calendar fields are int8.
     """
 
+    if timestamps is not None:
+        speeds, targets = _lag_context(speeds, timestamps)
 
-    # 2 - merge past and future speed ratios
-    df = speeds.copy()
-    df['sr']=df['speed']/df['reference_speed']
-    
-    dg=df[['tmc_code','measurement_tstamp','sr','average_speed','reference_speed']]
+    # 1 - pivot speed ratios into a (time x tmc) array
+    sr = (speeds['speed'] / speeds['reference_speed']).to_numpy().astype(dtype, copy=False)
+    t_codes, times = pd.factorize(speeds['measurement_tstamp'], sort=True)
+    k_codes, tmcs = pd.factorize(speeds['tmc_code'], sort=True)
+    times = np.asarray(times.values)
 
-    tmp = dg.copy()
-    for lag in ([5,10,15,20,25,30]):
-        dg1=tmp.copy()
-        dg1['measurement_tstamp'] += timedelta(hours=0, minutes=lag)
-        dg=dg.merge(dg1[['measurement_tstamp','tmc_code','sr']],on=['measurement_tstamp','tmc_code'],suffixes=['','_'+str(lag)], how='left')
+    # The extra last row stays NaN, it is used for missing lags
+    ratios = np.full((len(times) + 1, len(tmcs)), np.nan, dtype=dtype)
+    ratios[t_codes, k_codes] = sr
+
+    # 2 - past speed ratios, by shifting the time axis
+    sr_cols = ['sr'] + [f'sr_{lag}' for lag in LAGS]
+    blocks = [ratios[:-1]]
+    for lag in LAGS:
+        blocks.append(ratios[_lag_index(times, lag)])
+
+    # Rows are sorted by timestamp and tmc, and filtered to target tmcs
+    # (and target timestamps)
+    order = np.lexsort((k_codes, t_codes))
+    target = speeds['tmc_code'].isin(tmc_target.tmc_code).to_numpy()
+    if timestamps is not None:
+        target &= np.isin(times, targets)[t_codes]
+    rows = order[target[order]]
+    t_rows, k_rows = t_codes[rows], k_codes[rows]
+
+    dg = pd.DataFrame({
+        'tmc_code': pd.Categorical.from_codes(k_rows, pd.Index(tmcs).astype(str)),
+        'measurement_tstamp': speeds['measurement_tstamp'].iloc[rows].reset_index(drop=True),
+    })
+    dg['sr'] = sr[rows]
+    for col in ['average_speed', 'reference_speed']:
+        dg[col] = speeds[col].to_numpy()[rows]
+    for col, block in zip(sr_cols[1:], blocks[1:]):
+        dg[col] = block[t_rows, k_rows]
+
+    # 3 - Add all speed ratios, one column per tmc for each sr column
+    wide = np.hstack([block[t_rows] for block in blocks])
+    wide_cols = [f'{col}_{tmc}' for col in sr_cols for tmc in tmcs]
+    dg = pd.concat([dg, pd.DataFrame(wide, columns=wide_cols)], axis=1, copy=False)
 
-    dg = dg.sort_values(['measurement_tstamp', 'tmc_code'])
-    
-    # 3 - Add all speed ratios
-    tmcs = sorted(list(dg.tmc_code.unique()))
-    for col in ['sr','sr_5', 'sr_10', 'sr_15','sr_20','sr_25','sr_30']:
-        v=dg[['measurement_tstamp',col]].groupby(['measurement_tstamp'])[col].apply(lambda x: x.tolist())
-        dg=dg.merge(pd.DataFrame(v.tolist(), index=v.index)\
-           .rename(columns=lambda x: f'_{tmcs[x]}')\
-           .add_prefix(col)\
-           .reset_index())    
-        
     # Add speed ratio flags
-    dg['sr_flag']=0
-    dg.loc[dg['sr']<0.6,'sr_flag']=1    
-    
-    # 5 - Filter TMCS
-    dg=dg.loc[(dg['tmc_code'].isin(tmc_target.tmc_code))].reset_index(drop=True)
+    dg['sr_flag'] = (dg['sr'] < 0.6).astype(np.int64)
     
     # 6 - Add temporal variables
-    dg['season']=dg['measurement_tstamp'].dt.quarter
-    dg['month']=dg['measurement_tstamp'].dt.month
-    dg['dow']=dg['measurement_tstamp'].dt.weekday
-    dg['hour']=dg['measurement_tstamp'].dt.hour    
+    dg['season']=dg['measurement_tstamp'].dt.quarter.astype(np.int8)
+    dg['month']=dg['measurement_tstamp'].dt.month.astype(np.int8)
+    dg['dow']=dg['measurement_tstamp'].dt.weekday.astype(np.int8)
+    dg['hour']=dg['measurement_tstamp'].dt.hour.astype(np.int8)
     
+    # Steps 7-9 add columns as left merges on unique keys would, without
+    # copying the (wide) frame for each merge
 
     # 7 Add lane status
-    lane_data['measurement_tstamp']=pd.to_datetime(lane_data['measurement_tstamp'], utc=True).dt.floor("5min")
-    dg=dg.merge(lane_data[['measurement_tstamp', 'West', 'East']],
-                on=['measurement_tstamp'], how='left')    
+    lane_index = pd.Index(pd.to_datetime(lane_data['measurement_tstamp'], utc=True).dt.floor("5min"))
+    for col in ['West', 'East']:
+        dg[col] = _lookup(dg['measurement_tstamp'], lane_index, lane_data[col])
     
 
     # 8 - Add length and distance
-    dg=dg.merge(tmc_target , on=['tmc_code'],how='left')    
+    target_index = pd.Index(tmc_target['tmc_code'])
+    for col in tmc_target.columns.drop('tmc_code'):
+        dg[col] = _lookup(dg['tmc_code'].astype(str), target_index, tmc_target[col])
     
     # 9 - Add queue info
-
-    dg=dg.merge(queue_data[[ 'measurement_tstamp','queue','queue_5', 'queue_10', 'queue_15', 'queue_20', 'queue_25', 'queue_30']],how='left')
+    queue_index = pd.Index(queue_data['measurement_tstamp'])
+    for col in ['queue'] + [f'queue_{lag}' for lag in LAGS]:
+        dg[col] = _lookup(dg['measurement_tstamp'], queue_index, queue_data[col])
     
     
     return dg
 
 
+def expand_configurations(ml_data, configurations=LANE_CONFIGURATIONS):
+    """
+    Replicates ML data for each lane configuration
+    Args:
+        ml_data (pd.DataFrame): ML data, as returned by prepare_ml_data
+        configurations (pd.DataFrame): East and West lane counts
+    Returns:
+        pd.DataFrame: ml_data rows for each configuration (configuration
+                      major), with East and West set to the configuration
+    """
+    rows = np.tile(np.arange(len(ml_data)), len(configurations))
+    ret = ml_data.iloc[rows].reset_index(drop=True)
+    for col in configurations.columns:
+        ret[col] = np.repeat(configurations[col].to_numpy(), len(ml_data))
+    return ret
@@ -0,0 +1,89 @@
+# Bounded cache of estimate results. Speed data only change on 5 minute
+# boundaries, so results are kept until the end of their 5 minute bucket.
+# Classes:
+# - ResultCache: LRU cache with per entry expiry and hit/miss counters
+
+import threading
+from collections import OrderedDict
+
+
+class ResultCache:
+    """
+    LRU cache with per entry expiry time
+
+    Attributes:
+        maxsize (int): maximum number of entries. 0 disables the cache.
+        hits (int): number of get calls that found a valid entry
+        misses (int): number of get calls that did not
+        evictions (int): number of entries removed to respect maxsize
+    """
+
+    def __init__(self, maxsize=32):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, now):
+        """
+        Returns the value stored under key, None if it is missing or expired
+
+        Args:
+            key: hashable key
+            now (datetime): current time, compared with the entry expiry
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, expires, now):
+        """
+        Stores value under key until expires. Expired entries are dropped
+        and the least recently used entries are evicted if the cache is full.
+
+        Args:
+            key: hashable key
+            value: cached value
+            expires (datetime): expiry time of the entry
+            now (datetime): current time
+        """
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            for old_key in [k for k, (t, _) in self.entries.items() if t <= now]:
+                del self.entries[old_key]
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Returns:
+            dict: hits, misses, evictions and current size
+        """
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.entries),
+            }
@@ -0,0 +1,284 @@
+# Precompute scheduler. Speed data change on 5 minute boundaries, so instead
+# of estimating on each request, the estimates of both directions and all
+# horizons are computed once shortly after each boundary, stored, and
+# pushed to subscribers (server-sent events, see service.py). With several
+# service workers, one scheduler process writes each result to a shared file
+# and every worker follows that file.
+# Classes:
+# - PrecomputeFeed: Latest precomputed result and its subscribers
+# - PrecomputeScheduler: asyncio loop that estimates after each boundary
+# - PrecomputeFollower: Feed of the results another process writes to a file
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from json import dumps, loads
+
+
+INTERVAL = timedelta(minutes=5)
+
+
+def next_tick(now, offset):
+    """
+    Returns the next 5 minute boundary + offset after now
+
+    Args:
+        now (datetime): current time (UTC)
+        offset (float): seconds after the boundary
+    """
+    bucket = now - timedelta(minutes=now.minute % 5, seconds=now.second,
+                             microseconds=now.microsecond)
+    tick = bucket + timedelta(seconds=offset)
+    while tick <= now:
+        tick += INTERVAL
+    return tick
+
+
+class PrecomputeFeed:
+    """
+    Latest precomputed result and its subscribers
+
+    Attributes:
+        keepalive (float): seconds between keepalive comments of /stream
+        latest (dict): last result: tick (measurement interval, datetime),
+                       json (estimate_all_directions json output), None
+                       before the first tick
+        ticks (int): number of completed ticks
+        errors (int): number of failed ticks
+    """
+
+    def __init__(self, keepalive=15):
+        self.keepalive = keepalive
+        self.latest = None
+        self.ticks = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.subscribers = set()
+
+    def current(self):
+        """
+        Returns:
+            str: json of the latest result if it is for the current 5 minute
+                 interval, None otherwise
+        """
+        latest = self.latest
+        if latest is None:
+            return None
+        if datetime.now(timezone.utc) - latest['tick'] >= INTERVAL:
+            return None
+        return latest['json']
+
+    def subscribe(self):
+        """
+        Returns:
+            queue.Queue: queue receiving each new result (the latest dict)
+        """
+        subscriber = queue.Queue(maxsize=4)
+        with self.lock:
+            self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def publish(self, result):
+        """
+        Stores result as the latest one and pushes it to the subscribers.
+        Subscribers that do not keep up lose their oldest results.
+        """
+        with self.lock:
+            self.latest = result
+            subscribers = list(self.subscribers)
+        for subscriber in subscribers:
+            while True:
+                try:
+                    subscriber.put_nowait(result)
+                    break
+                except queue.Full:
+                    try:
+                        subscriber.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def stats(self):
+        """
+        Returns:
+            dict: ticks, errors, subscribers and the latest tick
+        """
+        with self.lock:
+            latest = self.latest
+            subscribers = len(self.subscribers)
+        return {
+            'ticks': self.ticks,
+            'errors': self.errors,
+            'subscribers': subscribers,
+            'latest': None if latest is None else latest['tick'].isoformat(),
+        }
+
+
+class PrecomputeScheduler(PrecomputeFeed):
+    """
+    Estimates both directions and all horizons (all lane configurations)
+    offset seconds after each 5 minute boundary, in an asyncio loop. The
+    estimates go through ModelZoo.estimate_all_directions, so they also fill
+    the result cache of the process running the scheduler.
+
+    Attributes:
+        modelzoo (ModelZoo): models used for the estimates
+        offset (float): seconds after the boundary, when the speeds of the
+                        new interval are available
+        path (str): if set, each tick writes the latest result and the
+                    counters to this file (see PrecomputeFollower)
+    """
+
+    def __init__(self, modelzoo, offset=30, keepalive=15, path=None):
+        super().__init__(keepalive)
+        self.modelzoo = modelzoo
+        self.offset = offset
+        self.path = path
+        self.thread = None
+        self.loop = None
+        self.stopping = None
+
+    def compute(self):
+        """
+        Estimates both directions for the current 5 minute interval
+
+        Returns:
+            dict: tick (start of the interval) and json output
+        """
+        now = datetime.now(timezone.utc)
+        res = self.modelzoo.estimate_all_directions(forecast_horizon='all',
+                                                    read_config=False,
+                                                    outputformat='json')
+        tick = now - timedelta(minutes=now.minute % 5, seconds=now.second,
+                               microseconds=now.microsecond)
+        return {'tick': tick, 'json': res}
+
+    def write(self):
+        """
+        Writes the latest result and the counters to path, atomically: a
+        json header line (tick, ticks, errors), then the json output
+        """
+        latest = self.latest
+        header = {
+            'tick': None if latest is None else latest['tick'].isoformat(),
+            'ticks': self.ticks,
+            'errors': self.errors,
+        }
+        body = '' if latest is None else latest['json']
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(dumps(header) + '\n' + body)
+        os.replace(tmp, self.path)
+
+    async def run(self):
+        """
+        Computes an estimate now, then after each boundary + offset, until
+        stop() is called
+        """
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        while not self.stopping.is_set():
+            try:
+                result = await loop.run_in_executor(None, self.compute)
+                self.ticks += 1
+                self.publish(result)
+            except Exception:
+                # The next tick retries; the previous result stays available
+                self.errors += 1
+            if self.path is not None:
+                self.write()
+
+            tick = next_tick(datetime.now(timezone.utc), self.offset)
+            delay = (tick - datetime.now(timezone.utc)).total_seconds()
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    def run_forever(self):
+        """
+        Runs the scheduler in the calling thread (e.g. a dedicated process)
+        """
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            self.loop.close()
+
+    def start(self):
+        """
+        Starts the scheduler in a daemon thread, for a single process service
+        """
+        self.thread = threading.Thread(target=self.run_forever, name='precompute',
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.loop is not None and self.stopping is not None:
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        if self.thread is not None:
+            self.thread.join()
+
+
+class PrecomputeFollower(PrecomputeFeed):
+    """
+    Feed of the results a PrecomputeScheduler of another process writes to
+    path. A daemon thread checks the file every poll seconds and publishes
+    each new tick to the local subscribers.
+
+    Attributes:
+        path (str): file written by PrecomputeScheduler.write
+        poll (float): seconds between checks of the file
+    """
+
+    def __init__(self, path, poll=1, keepalive=15):
+        super().__init__(keepalive)
+        self.path = path
+        self.poll = poll
+        self.mtime = None
+        self.thread = None
+
+    def read(self):
+        """
+        Reads the file if it changed, and publishes its result if it is new
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        with open(self.path) as f:
+            header, _, body = f.read().partition('\n')
+        header = loads(header)
+        self.ticks, self.errors = header['ticks'], header['errors']
+        if header['tick'] is None:
+            return
+        tick = datetime.fromisoformat(header['tick'])
+        if self.latest is None or self.latest['tick'] != tick:
+            self.publish({'tick': tick, 'json': body})
+
+    def start(self):
+        """
+        Starts following the file in a daemon thread. Call it in the process
+        that serves the requests (after forking workers).
+        """
+        def target():
+            while True:
+                try:
+                    self.read()
+                except (OSError, ValueError):
+                    # Retried at the next poll
+                    pass
+                time.sleep(self.poll)
+
+        self.thread = threading.Thread(target=target, name='precompute-follower',
+                                       daemon=True)
+        self.thread.start()
@@ -0,0 +1,265 @@
+# Serialization of estimate results (as returned by ModelZoo.estimate).
+# The outputs are byte-identical to json.dumps(ModelZoo.get_json_body_dic())
+# and DataFrame.to_csv(index=False), but are built column-wise in one pass.
+# The arrow output is the Arrow IPC stream format, with a fixed schema, for
+# consumers that read columns without parsing text.
+# Functions:
+# - render_json_body: Renders the predictions body of the json output
+# - render_csv: Renders a dataframe as csv
+# - arrow_schema: Returns the schema of the arrow output
+# - arrow_table: Converts estimates to an arrow table with the fixed schema
+# - render_arrow: Renders estimates in the Arrow IPC stream format
+# - write_arrow_stream: Writes estimates to an Arrow IPC stream batch by batch
+# - read_arrow: Reads an arrow output into a dataframe
+
+import csv
+import io
+import math
+from json import dumps
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from processdata import LANE_CONFIGURATIONS
+
+
+HORIZONS = [5, 10, 15, 20, 25, 30]
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+# Fixed part of the arrow schema. Leading columns (e.g. direction, asof)
+# and the sr_pred_{horizon} columns (float32) are added per output.
+ARROW_FIELDS = [
+    pa.field('tmc_code', pa.dictionary(pa.int32(), pa.string()), nullable=False),
+    pa.field('measurement_tstamp', pa.timestamp('s', tz='UTC'), nullable=False),
+    pa.field('West', pa.int8()),
+    pa.field('East', pa.int8()),
+    pa.field('reference_speed', pa.float32()),
+]
+ARROW_LEADING_FIELDS = {
+    'direction': pa.field('direction', pa.dictionary(pa.int32(), pa.string())),
+    'asof': pa.field('asof', pa.timestamp('s', tz='UTC')),
+}
+
+
+def _float_str(value):
+    # Same as the json module float representation
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return float.__repr__(value)
+
+
+def _json_floats(values):
+    values = np.asarray(values, dtype=np.float64)
+    if np.isfinite(values).all():
+        return list(map(float.__repr__, values.tolist()))
+    return list(map(_float_str, values.tolist()))
+
+
+def render_json_body(res_df, configurations=LANE_CONFIGURATIONS):
+    """
+    Renders the predictions body of the json output
+
+    Args:
+        res_df (pd.DataFrame): predictions, as returned by ModelZoo.estimate
+        configurations (pd.DataFrame): BB configurations (East, West), in
+                                       the output order
+
+    Returns:
+        str: json object in format
+            {"E1W1": {"horizon_5": {"TMC_code1": speed_ratio1, ...}, ...}, ...}
+            for all configurations present in res_df
+    """
+    east_values = res_df['East'].to_numpy()
+    west_values = res_df['West'].to_numpy()
+    horizons = [x for x in HORIZONS if f'sr_pred_{x}' in res_df.columns]
+    keys = [dumps(str(x)) for x in res_df['tmc_code'].tolist()]
+    values = {
+        horizon: _json_floats(res_df[f'sr_pred_{horizon}'].to_numpy())
+        for horizon in horizons
+    }
+
+    body = []
+    for east, west in configurations[['East', 'West']].itertuples(index=False):
+        rows = np.flatnonzero((east_values == east) & (west_values == west))
+        if len(rows) == 0:
+            continue
+        take = itemgetter(*rows) if len(rows) > 1 else lambda x: (x[rows[0]], )
+        tmcs = take(keys)
+        # A dict keeps the semantics of repeated tmcs in the dict output
+        predictions = ', '.join(
+            f'"horizon_{horizon}": {{' +
+            ', '.join(map(': '.join, dict(zip(tmcs, take(values[horizon]))).items())) + '}'
+            for horizon in horizons)
+        body.append(f'"E{east}W{west}": {{{predictions}}}')
+
+    return '{' + ', '.join(body) + '}'
+
+
+def _csv_column(series):
+    """
+    Formats a column as DataFrame.to_csv does, None if the dtype is not
+    supported
+    """
+    if pd.api.types.is_float_dtype(series.dtype):
+        # numpy str() gives the shortest repr of float32 and float64, as pandas
+        values = series.to_numpy().astype(str)
+    elif pd.api.types.is_integer_dtype(series.dtype) or pd.api.types.is_bool_dtype(series.dtype):
+        return series.to_numpy().astype(str)
+    elif pd.api.types.is_datetime64_any_dtype(series.dtype):
+        # Timestamps repeat, so only the distinct ones are formatted
+        codes, uniques = pd.factorize(series)
+        values = np.append(uniques.astype(str).to_numpy(dtype=object), '')[codes]
+    elif isinstance(series.dtype, pd.CategoricalDtype):
+        # Categories are formatted once
+        codes = series.cat.codes.to_numpy()
+        categories = series.cat.categories.astype(str).to_numpy(dtype=object)
+        values = np.append(categories, '')[codes]
+    elif series.dtype == object:
+        values = series.astype(str).to_numpy()
+    else:
+        return None
+    values[series.isna().to_numpy()] = ''
+    return values
+
+
+def render_csv(df, lineterminator='\n'):
+    """
+    Renders a dataframe as csv, as df.to_csv(index=False,
+    line_terminator=lineterminator)
+
+    Args:
+        df (pd.DataFrame): dataframe
+        lineterminator (str): line terminator
+
+    Returns:
+        str: csv
+    """
+    columns = None
+    if df.columns.is_unique:
+        columns = [_csv_column(df[col]) for col in df.columns]
+    if columns is None or any(x is None for x in columns):
+        return df.to_csv(index=False, line_terminator=lineterminator)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator=lineterminator)
+    writer.writerow([str(x) for x in df.columns])
+    writer.writerows(zip(*columns))
+    return buffer.getvalue()
+
+
+def arrow_schema(horizons=HORIZONS, leading=()):
+    """
+    Returns the schema of the arrow output
+
+    Args:
+        horizons (list): horizons of the sr_pred_{horizon} columns
+        leading (list): names of leading columns (direction, asof)
+
+    Returns:
+        pa.Schema: leading columns, tmc_code (dictionary), measurement_tstamp
+                   (UTC, seconds), West, East (int8), reference_speed and
+                   sr_pred_{horizon} (float32)
+    """
+    fields = [ARROW_LEADING_FIELDS[x] for x in leading] + ARROW_FIELDS
+    fields += [pa.field(f'sr_pred_{x}', pa.float32()) for x in horizons]
+    return pa.schema(fields)
+
+
+def _arrow_column(series, field):
+    if pa.types.is_dictionary(field.type):
+        # Categories are converted once, as the dictionary
+        if not isinstance(series.dtype, pd.CategoricalDtype):
+            series = series.astype(str).astype('category')
+        codes = series.cat.codes.to_numpy()
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes.astype(np.int32), mask=codes < 0),
+            pa.array(series.cat.categories.astype(str).to_numpy(dtype=object), pa.string()))
+    if pa.types.is_timestamp(field.type):
+        series = pd.to_datetime(series, utc=True).dt.floor('s')
+    return pa.Array.from_pandas(series).cast(field.type)
+
+
+def arrow_table(res_df):
+    """
+    Converts estimates to an arrow table with the fixed schema
+
+    Args:
+        res_df (pd.DataFrame): estimates, as returned by ModelZoo.estimate,
+                               optionally with leading direction/asof columns
+
+    Returns:
+        pa.Table: table with the arrow_schema of its horizons
+    """
+    horizons = [x for x in HORIZONS if f'sr_pred_{x}' in res_df.columns]
+    leading = [x for x in ARROW_LEADING_FIELDS if x in res_df.columns]
+    schema = arrow_schema(horizons, leading)
+    columns = [_arrow_column(res_df[field.name], field) for field in schema]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def render_arrow(res_df):
+    """
+    Renders estimates in the Arrow IPC stream format
+
+    Args:
+        res_df (pd.DataFrame): estimates, see arrow_table
+
+    Returns:
+        bytes: Arrow IPC stream with one record batch
+    """
+    table = arrow_table(res_df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def write_arrow_stream(sink, frames):
+    """
+    Writes estimates to an Arrow IPC stream, one record batch per frame, as
+    the frames are produced (e.g. backtest chunks). All frames must have the
+    same columns.
+
+    Args:
+        sink (str or file-like): output file
+        frames (iterable): estimates dataframes, see arrow_table. Empty
+                           frames are skipped.
+
+    Returns:
+        int: number of written rows
+    """
+    writer = None
+    rows = 0
+    try:
+        for res_df in frames:
+            if len(res_df) == 0:
+                continue
+            table = arrow_table(res_df)
+            if writer is None:
+                writer = pa.ipc.new_stream(sink, table.schema)
+            writer.write_table(table)
+            rows += len(res_df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def read_arrow(source):
+    """
+    Reads an arrow output (render_arrow or write_arrow_stream) into a
+    dataframe
+
+    Args:
+        source (bytes, str or file-like): arrow output, or its file
+
+    Returns:
+        pd.DataFrame: estimates, tmc_code categorical
+    """
+    if isinstance(source, bytes):
+        source = pa.BufferReader(source)
+    with pa.ipc.open_stream(source) as reader:
+        return reader.read_all().to_pandas()
@@ -0,0 +1,307 @@
+# Long-running HTTP service around ModelZoo. The models and TMC tables are
+# loaded once at startup and reused by every request.
+# Functions:
+# - create_app: Builds the Flask application for a ModelZoo instance
+# - serve: Runs the application in one or several pre-forked workers
+
+import os
+import queue
+import signal
+import tempfile
+from datetime import datetime, timedelta
+from json import dumps
+
+from flask import Flask, Response, request
+from werkzeug.serving import make_server
+
+from metrics import METRICS
+from scheduler import PrecomputeFollower
+from serialize import ARROW_CONTENT_TYPE
+
+
+DIRECTIONS = ['East', 'West', 'both']
+HORIZONS = ['all', '5', '10', '15', '20', '25', '30']
+OUTPUT_FORMATS = ['json', 'csv', 'arrow']
+MIMETYPES = {
+    'json': 'application/json',
+    'csv': 'text/csv',
+    'arrow': ARROW_CONTENT_TYPE,
+}
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Instants of one /estimate/batch request (24 hours every 5 minutes)
+MAX_BATCH_INSTANTS = 288
+
+
+def _error(message, status=400):
+    return Response(dumps({'error': message}), status=status,
+                    mimetype='application/json')
+
+
+def _read_bool(value):
+    return str(value).lower() in ['1', 'true', 'yes']
+
+
+def _event(result):
+    # Server-sent event, one data line per line of the json
+    data = ''.join(f'data: {line}\n' for line in result['json'].splitlines())
+    return f'id: {result["tick"].isoformat()}\nevent: estimate\n{data}\n'
+
+
+def create_app(modelzoo, scheduler=None):
+    """
+    Builds the Flask application for a ModelZoo instance
+
+    Args:
+        modelzoo (ModelZoo): loaded ModelZoo used to answer all requests
+        scheduler (PrecomputeScheduler, optional): precomputes the estimates
+            of both directions after each 5 minute boundary. Started by
+            serve(), once for all workers.
+
+    Returns:
+        Flask: application with the following endpoints:
+            /estimate?direction=East&horizon=all&outputformat=json&read_config=false&deadline=2.5
+            /estimate/batch?direction=East&start=2022-10-05T06:00&end=2022-10-05T12:00&step=5&horizon=all&outputformat=json
+            /health
+            /metrics (Prometheus text format, of the worker answering)
+            /latest (with a scheduler, its latest estimates)
+            /stream (with a scheduler, server-sent events with the estimates
+                     of each 5 minute interval)
+    """
+
+    app = Flask(__name__)
+    app.config['MODELZOO'] = modelzoo
+    app.config['SCHEDULER'] = scheduler
+    # Feed of the precomputed estimates read by the requests: the scheduler
+    # itself, or in forked workers a follower of the scheduler process
+    app.config['PRECOMPUTE'] = scheduler
+
+    def precompute():
+        return app.config['PRECOMPUTE']
+
+    @app.route('/estimate')
+    def estimate():
+        direction = request.args.get('direction', 'East')
+        horizon = request.args.get('horizon', 'all')
+        outputformat = request.args.get('outputformat', 'json')
+        read_config = _read_bool(request.args.get('read_config', 'false'))
+        deadline = request.args.get('deadline', modelzoo.DEADLINE)
+
+        if direction not in DIRECTIONS:
+            return _error(f'direction must be one of {DIRECTIONS}')
+        if horizon not in HORIZONS:
+            return _error(f'horizon must be one of {HORIZONS}')
+        if outputformat not in OUTPUT_FORMATS:
+            return _error(f'outputformat must be one of {OUTPUT_FORMATS}')
+        if deadline is not None:
+            try:
+                deadline = float(deadline)
+            except ValueError:
+                return _error('deadline must be a number of seconds')
+            if deadline <= 0:
+                return _error('deadline must be positive')
+
+        res = None
+        if (precompute() is not None and direction == 'both' and horizon == 'all'
+                and not read_config and outputformat == 'json'):
+            # Precomputed for the current interval
+            res = precompute().current()
+
+        if res is not None:
+            return Response(res, mimetype=MIMETYPES[outputformat])
+
+        if direction == 'both':
+            res = modelzoo.estimate_all_directions(
+                forecast_horizon=horizon,
+                read_config=read_config,
+                outputformat=outputformat,
+                deadline=deadline)
+        else:
+            res = modelzoo.estimate_now(
+                direction=direction,
+                forecast_horizon=horizon,
+                read_config=read_config,
+                outputformat=outputformat,
+                deadline=deadline)
+
+        return Response(res, mimetype=MIMETYPES[outputformat])
+
+    @app.route('/estimate/batch')
+    def estimate_batch():
+        direction = request.args.get('direction', 'East')
+        horizon = request.args.get('horizon', 'all')
+        outputformat = request.args.get('outputformat', 'json')
+
+        if direction not in DIRECTIONS[:2]:
+            return _error(f'direction must be one of {DIRECTIONS[:2]}')
+        if horizon not in HORIZONS:
+            return _error(f'horizon must be one of {HORIZONS}')
+        if outputformat not in OUTPUT_FORMATS:
+            return _error(f'outputformat must be one of {OUTPUT_FORMATS}')
+        try:
+            start = datetime.fromisoformat(request.args['start'])
+            end = datetime.fromisoformat(request.args.get('end', request.args['start']))
+            step = int(request.args.get('step', 5))
+            valid = step > 0 and end >= start
+        except (KeyError, ValueError, TypeError):
+            return _error('start (and end) must be ISO timestamps, step an integer')
+        if not valid:
+            return _error('step must be positive and end not before start')
+        instants = int((end - start) / timedelta(minutes=step)) + 1
+        if instants > MAX_BATCH_INSTANTS:
+            return _error(f'at most {MAX_BATCH_INSTANTS} instants per request')
+
+        res = modelzoo.estimate_batch(
+            direction=direction,
+            asof_list=[start + i * timedelta(minutes=step) for i in range(instants)],
+            horizons=horizon,
+            outputformat=outputformat)
+        return Response(res, mimetype=MIMETYPES[outputformat])
+
+    @app.route('/health')
+    def health():
+        return Response(dumps({
+            'status': 'ok',
+            'version': modelzoo.VERSION,
+            'pid': os.getpid(),
+            'cache': modelzoo.result_cache.stats(),
+            'lane_status': modelzoo.status_watcher.stats(),
+            'precompute': None if precompute() is None else precompute().stats(),
+        }), mimetype='application/json')
+
+    @app.route('/metrics')
+    def metrics():
+        cache = modelzoo.result_cache.stats()
+        lines = [METRICS.render_prometheus()]
+        for name, value in cache.items():
+            kind = 'gauge' if name == 'size' else 'counter'
+            metric = f'bbq_result_cache_{name}' + ('' if kind == 'gauge' else '_total')
+            lines.append(f'# TYPE {metric} {kind}\n{metric} {value}\n')
+        if precompute() is not None:
+            stats = precompute().stats()
+            lines.append(f'# TYPE bbq_precompute_ticks_total counter\n'
+                         f'bbq_precompute_ticks_total {stats["ticks"]}\n'
+                         f'# TYPE bbq_precompute_errors_total counter\n'
+                         f'bbq_precompute_errors_total {stats["errors"]}\n'
+                         f'# TYPE bbq_precompute_subscribers gauge\n'
+                         f'bbq_precompute_subscribers {stats["subscribers"]}\n')
+        return Response(''.join(lines), content_type=PROMETHEUS_CONTENT_TYPE)
+
+    if scheduler is None:
+        return app
+
+    @app.route('/latest')
+    def latest():
+        result = precompute().latest
+        if result is None:
+            return _error('no estimate computed yet', status=503)
+        return Response(result['json'], mimetype=MIMETYPES['json'])
+
+    @app.route('/stream')
+    def stream():
+        feed = precompute()
+        subscriber = feed.subscribe()
+
+        def events():
+            try:
+                if feed.latest is not None:
+                    yield _event(feed.latest)
+                while True:
+                    try:
+                        result = subscriber.get(timeout=feed.keepalive)
+                    except queue.Empty:
+                        # Comment line, keeps proxies from closing the
+                        # connection and detects closed clients
+                        yield ': keepalive\n\n'
+                        continue
+                    yield _event(result)
+            finally:
+                feed.unsubscribe(subscriber)
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+
+    return app
+
+
+def serve(app, host='0.0.0.0', port=5000, workers=1):
+    """
+    Runs the application. The listening socket is opened once and shared by
+    all workers, so the models loaded before the fork are shared too.
+
+    Args:
+        app (Flask): application returned by create_app
+        host (str): interface to listen on
+        port (int): port to listen on
+        workers (int): number of worker processes. Each worker serves
+                       requests in threads. With a scheduler, it runs in
+                       one more process, which writes each result to a
+                       file that every worker follows.
+    """
+
+    server = make_server(host, port, app, threaded=True)
+    scheduler = app.config.get('SCHEDULER')
+
+    if workers <= 1:
+        if scheduler is not None:
+            scheduler.start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+        return
+
+    if scheduler is not None:
+        # The parent stays single threaded (workers are forked from it), so
+        # the scheduler runs in its own process
+        scheduler.path = os.path.join(tempfile.mkdtemp(prefix='bbq-precompute-'),
+                                      'latest.json')
+        app.config['PRECOMPUTE'] = PrecomputeFollower(scheduler.path,
+                                                      keepalive=scheduler.keepalive)
+
+    children = {}
+    stopping = False
+
+    def spawn(role='worker'):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                if role == 'scheduler':
+                    server.socket.close()
+                    scheduler.run_forever()
+                else:
+                    if scheduler is not None:
+                        app.config['PRECOMPUTE'].start()
+                    server.serve_forever()
+            finally:
+                os._exit(0)
+        children[pid] = role
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for _ in range(workers):
+        spawn()
+    if scheduler is not None:
+        spawn('scheduler')
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Restart workers (and the scheduler) that die, until we are asked to stop
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        role = children.pop(pid, None)
+        if not stopping and role is not None:
+            spawn(role)
+
+    server.server_close()
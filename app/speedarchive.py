@@ -0,0 +1,224 @@
+# Local archive of raw speed and lane status pulls. Pulls are stored as
+# parquet files partitioned by day (ROOT/speed/date=YYYY-MM-DD/...), with
+# compact dtypes and dictionary encoded strings (tmc codes are read back as
+# categoricals), so that offline jobs can read any time range without
+# requesting the endpoints.
+# Classes:
+# - SpeedArchive: Writes pulls and reads time ranges of the archive
+
+import os
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+SPEED_SCHEMA = pa.schema([
+    ('tmc_code', pa.string()),
+    ('measurement_tstamp', pa.timestamp('s')),
+    ('speed', pa.int16()),
+    ('average_speed', pa.int16()),
+    ('reference_speed', pa.int16()),
+    ('travel_time_minutes', pa.float32()),
+    ('pulled_at', pa.timestamp('ms')),
+])
+STATUS_SCHEMA = pa.schema([
+    ('measurement_tstamp', pa.timestamp('ms')),
+    ('L1status', pa.string()),
+    ('L2status', pa.string()),
+    ('L3status', pa.string()),
+    ('L4status', pa.string()),
+    ('L5status', pa.string()),
+    ('West', pa.int8()),
+    ('East', pa.int8()),
+])
+# dtypes of get_speed_data
+SPEED_DTYPES = {
+    'tmc_code': 'category',
+    'speed': 'int64',
+    'average_speed': 'int64',
+    'reference_speed': 'int64',
+    'travel_time_minutes': 'float64',
+}
+
+
+def _utc_naive(values, unit):
+    # Archived timestamps are naive UTC. Naive input is assumed to be UTC.
+    return pd.to_datetime(values, utc=True).dt.tz_localize(None).dt.floor(unit)
+
+
+def _utc_timestamp(value):
+    value = pd.Timestamp(value)
+    if value.tzinfo is not None:
+        value = value.tz_convert('UTC').tz_localize(None)
+    return value.to_pydatetime()
+
+
+class SpeedArchive:
+    """
+    Day partitioned parquet archive of speed and lane status pulls. Each
+    pull is written to new files (one per day it covers), renamed into
+    place once complete, so concurrent writers and readers are safe.
+    Speed pulls overlap (each covers the whole endpoint window), so only
+    the records newer than the last archived one of their tmc are written.
+    Timestamps are stored as naive UTC. Strings are dictionary encoded by
+    parquet.
+
+    Attributes:
+        path (str): root directory of the archive
+        last (dict): {tmc_code: latest archived measurement_tstamp}, read
+                     from the archive on the first write of the process
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last = None
+        self.lock = threading.Lock()
+
+    def _partition(self, kind, day):
+        return os.path.join(self.path, kind, f'date={day:%Y-%m-%d}')
+
+    def _write(self, kind, df, schema, days):
+        name = f'part-{datetime.utcnow():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}.parquet'
+        for day, part in df.groupby(days, sort=False):
+            directory = self._partition(kind, day)
+            os.makedirs(directory, exist_ok=True)
+            target = os.path.join(directory, name)
+            table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+            pq.write_table(table, target + '.tmp')
+            os.replace(target + '.tmp', target)
+
+    def _last_archived(self, start):
+        # Latest archived measurement_tstamp of each tmc, from start's day on
+        files = self._files('speed', start, datetime.utcnow())
+        if len(files) == 0:
+            return {}
+        df = ds.dataset(files, schema=SPEED_SCHEMA, format='parquet').to_table(
+            columns=['tmc_code', 'measurement_tstamp']).to_pandas()
+        return df.groupby('tmc_code')['measurement_tstamp'].max().to_dict()
+
+    def write_speeds(self, df, pulled_at=None):
+        """
+        Archives the new records of a speed pull: those after the last
+        archived measurement_tstamp of their tmc. Records of intervals
+        already archived are not rewritten.
+
+        Args:
+            df (pd.DataFrame): speeds, as returned by get_speed_data
+            pulled_at (datetime, optional): time of the pull. Now if None.
+        """
+        if len(df) == 0:
+            return
+        df = df[[f.name for f in SPEED_SCHEMA if f.name != 'pulled_at']].copy()
+        df['tmc_code'] = df['tmc_code'].astype(str)
+        df['measurement_tstamp'] = _utc_naive(df['measurement_tstamp'], 's')
+        df['pulled_at'] = pd.Timestamp(_utc_timestamp(pulled_at or datetime.utcnow())).floor('ms')
+
+        with self.lock:
+            if self.last is None:
+                self.last = self._last_archived(df['measurement_tstamp'].min())
+            # NaT (tmc never archived) compares False, so the rows are kept
+            last = pd.to_datetime(df['tmc_code'].map(self.last))
+            df = df[~(df['measurement_tstamp'] <= last)]
+            if len(df) == 0:
+                return
+            self._write('speed', df, SPEED_SCHEMA, df['measurement_tstamp'].dt.date)
+            self.last.update(df.groupby('tmc_code')['measurement_tstamp'].max().to_dict())
+
+    def write_status(self, df):
+        """
+        Archives a lane status pull
+
+        Args:
+            df (pd.DataFrame): lane status, as returned by
+                               get_bb_current_status_df. Lane statuses are
+                               stored as strings (closed lanes as '0').
+        """
+        df = df[STATUS_SCHEMA.names].copy()
+        df['measurement_tstamp'] = _utc_naive(df['measurement_tstamp'], 'ms')
+        for col in ['L1status', 'L2status', 'L3status', 'L4status', 'L5status']:
+            df[col] = df[col].astype(str)
+        for col in ['West', 'East']:
+            df[col] = df[col].astype('int8')
+        self._write('status', df, STATUS_SCHEMA, df['measurement_tstamp'].dt.date)
+
+    def _files(self, kind, start, end):
+        # Partition pruning: only the directories of the requested days
+        files = []
+        day = start.date()
+        while day <= end.date():
+            directory = self._partition(kind, day)
+            if os.path.isdir(directory):
+                files += sorted(os.path.join(directory, x) for x in os.listdir(directory)
+                                if x.endswith('.parquet'))
+            day += timedelta(days=1)
+        return files
+
+    def read_speeds(self, start, end, tmc_list=None):
+        """
+        Reads archived speeds of a time range
+
+        Overlapping pulls are deduplicated, the latest pull of each tmc and
+        timestamp is kept.
+
+        Args:
+            start (datetime): first measurement timestamp (included). Naive
+                              timestamps are UTC.
+            end (datetime): last measurement timestamp (included)
+            tmc_list (list, optional): tmcs to read. All tmcs if None.
+
+        Returns:
+            pd.DataFrame: speeds in the get_speed_data format, sorted by
+                          measurement_tstamp and tmc_code
+        """
+        start, end = _utc_timestamp(start), _utc_timestamp(end)
+        columns = [f.name for f in SPEED_SCHEMA if f.name != 'pulled_at']
+        files = self._files('speed', start, end)
+        if len(files) == 0:
+            return pd.DataFrame({c: pd.Series(dtype=SPEED_DTYPES.get(c, 'datetime64[ns]'))
+                                 for c in columns})
+
+        tstamp = ds.field('measurement_tstamp')
+        condition = (tstamp >= pa.scalar(start, pa.timestamp('s'))) & \
+                    (tstamp <= pa.scalar(end, pa.timestamp('s')))
+        if tmc_list is not None:
+            condition &= ds.field('tmc_code').isin(list(tmc_list))
+        table = ds.dataset(files, schema=SPEED_SCHEMA, format='parquet').to_table(filter=condition)
+
+        df = table.to_pandas(strings_to_categorical=True)
+        df = df.sort_values('pulled_at', kind='mergesort')
+        df = df.drop_duplicates(['tmc_code', 'measurement_tstamp'], keep='last')
+        df = df.sort_values(['measurement_tstamp', 'tmc_code'], kind='mergesort')
+        return df[columns].astype(SPEED_DTYPES).reset_index(drop=True)
+
+    def read_status(self, start, end):
+        """
+        Reads archived lane status pulls of a time range
+
+        Args:
+            start (datetime): first pull time (included). Naive timestamps
+                              are UTC.
+            end (datetime): last pull time (included)
+
+        Returns:
+            pd.DataFrame: lane status in the get_bb_current_status_df
+                          format, one row per pull, sorted by time
+        """
+        start, end = _utc_timestamp(start), _utc_timestamp(end)
+        files = self._files('status', start, end)
+        if len(files) == 0:
+            return pd.DataFrame(columns=STATUS_SCHEMA.names)
+
+        tstamp = ds.field('measurement_tstamp')
+        condition = (tstamp >= pa.scalar(start, pa.timestamp('ms'))) & \
+                    (tstamp <= pa.scalar(end, pa.timestamp('ms')))
+        df = ds.dataset(files, schema=STATUS_SCHEMA, format='parquet').to_table(
+            filter=condition).to_pandas()
+        df['measurement_tstamp'] = df['measurement_tstamp'].dt.tz_localize('UTC')
+        for col in ['West', 'East']:
+            df[col] = df[col].astype('int64')
+        return df.sort_values('measurement_tstamp').reset_index(drop=True)
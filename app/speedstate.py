@@ -0,0 +1,128 @@
+# Rolling 5 minute speed state of one traffic direction. It keeps the latest
+# interval and its 30 minute lag window in a fixed size ring buffer, so each
+# new speed pull only has to aggregate the intervals that changed.
+# Classes:
+# - SpeedState: Ring buffer of 5 minute speed aggregates per tmc
+
+import threading
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+
+from getrawdata import agg_speed_5m
+from processdata import LAGS
+
+
+INTERVAL = timedelta(minutes=5)
+
+
+class SpeedState:
+    """
+    Ring buffer of 5 minute speed aggregates per tmc, covering the latest
+    interval and its lags. A 5 minute interval is stored in slot
+    (interval number % slots), so advancing the state only clears the
+    slots of the new intervals.
+
+    Attributes:
+        tmcs (pd.Index): sorted tmcs of the direction
+        slots (int): number of 5 minute intervals kept
+        latest (pd.Timestamp): newest interval in the state, None if empty
+        rebuilds (int): number of updates that rebuilt the state from scratch
+        increments (int): number of incremental updates
+    """
+
+    COLUMNS = ['speed', 'average_speed', 'reference_speed', 'travel_time_minutes']
+
+    def __init__(self, tmc_list, slots=len(LAGS) + 1):
+        self.tmcs = pd.Index(sorted(tmc_list))
+        self.slots = slots
+        self.lock = threading.Lock()
+        self.rebuilds = 0
+        self.increments = 0
+        self.reset()
+
+    def reset(self):
+        self.values = np.full((self.slots, len(self.tmcs), len(self.COLUMNS)), np.nan)
+        self.present = np.zeros((self.slots, len(self.tmcs)), dtype=bool)
+        self.latest = None
+
+    def _slot(self, tstamp):
+        return (tstamp.value // pd.Timedelta(INTERVAL).value) % self.slots
+
+    def _intervals(self):
+        # Intervals covered by the state, oldest first
+        return pd.date_range(end=self.latest, periods=self.slots, freq=INTERVAL)
+
+    def update(self, raw):
+        """
+        Updates the state with a speed pull and returns the current window
+
+        Only rows of the newest interval already in the state and later are
+        aggregated (the newest interval may have been incomplete), and never
+        rows older than the window ending at the newest interval of the pull. The state
+        is rebuilt from all rows if it is empty, if the pull does not reach
+        back to the newest interval in the state (a gap), or if the pull is
+        older than the state.
+
+        Args:
+            raw (pd.DataFrame): speeds, as returned by get_speed_data
+
+        Returns:
+            pd.DataFrame: 5 minute speeds of the window, in the
+                          agg_speed_5m format
+        """
+        with self.lock:
+            if len(raw) == 0:
+                return self.to_speeds()
+
+            tstamps = pd.to_datetime(raw['measurement_tstamp'], utc=True).dt.floor('5min')
+            first, newest = tstamps.min(), tstamps.max()
+
+            if self.latest is None or first > self.latest or newest < self.latest:
+                self.reset()
+                since = newest - (self.slots - 1) * INTERVAL
+                self.rebuilds += 1
+            else:
+                # Rows older than the window would wrap onto the slots of
+                # newer intervals
+                since = max(self.latest, newest - (self.slots - 1) * INTERVAL)
+                self.increments += 1
+
+            # Clears slots of the intervals that are (re)written
+            for tstamp in pd.date_range(since, newest, freq=INTERVAL)[-self.slots:]:
+                slot = self._slot(tstamp)
+                self.values[slot] = np.nan
+                self.present[slot] = False
+            self.latest = newest
+
+            agg = agg_speed_5m(raw[tstamps >= since])
+            k = self.tmcs.get_indexer(agg['tmc_code'])
+            agg, k = agg[k >= 0], k[k >= 0]
+            slots = np.array([self._slot(x) for x in agg['measurement_tstamp']], dtype=int)
+            self.values[slots, k] = agg[self.COLUMNS].to_numpy(dtype=np.float64)
+            self.present[slots, k] = True
+
+            return self.to_speeds()
+
+    def to_speeds(self):
+        """
+        Returns:
+            pd.DataFrame: 5 minute speeds of the window, in the agg_speed_5m
+                          format (sorted by tmc_code and measurement_tstamp)
+        """
+        if self.latest is None:
+            return pd.DataFrame(columns=['tmc_code', 'measurement_tstamp'] + self.COLUMNS)
+
+        intervals = self._intervals()
+        slots = [self._slot(x) for x in intervals]
+        # (tmc x interval) order, same as agg_speed_5m
+        k, j = np.nonzero(self.present[slots].T)
+        values = self.values[slots][j, k]
+
+        df = pd.DataFrame({
+            'tmc_code': pd.Categorical.from_codes(k, self.tmcs),
+            'measurement_tstamp': intervals[j],
+        })
+        for i, col in enumerate(self.COLUMNS):
+            df[col] = values[:, i]
+        return df
@@ -1,4 +1 @@
-export FLASK_APP="main"
-export FLASK_DEBUG=0
-export FLASK_RUN_HOST="0.0.0.0"
-flask run
\ No newline at end of file
+python main.py --serve --host "${BBQ_HOST:-0.0.0.0}" --port "${BBQ_PORT:-5000}" --workers "${BBQ_WORKERS:-2}" "$@"
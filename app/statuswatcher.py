@@ -0,0 +1,123 @@
+# Watcher of the baybridge status endpoint. The lane configuration rarely
+# changes, so the status is requested at most every min_interval seconds,
+# with a conditional request (ETag / Last-Modified) when the server supports
+# it and a hash of the response otherwise, and the lane table is only
+# rebuilt when the derived configuration changes.
+# Classes:
+# - StatusWatcher: Cached lane configuration of the status endpoint
+
+import hashlib
+import threading
+import time
+from json import loads
+
+from getrawdata import archive_status, http_get, lane_status_df, parse_lane_status
+from metrics import METRICS
+
+
+class StatusWatcher:
+    """
+    Cached lane configuration of the status endpoint
+
+    Attributes:
+        bb_endpoint (str): baybridge status endpoint
+        token (str): token for endpoints
+        min_interval (float): seconds during which the last status is used
+                              without a request. 0 checks it on every call.
+        lane_status (tuple): (statuses, West, East) as returned by
+                             parse_lane_status, None before the first poll
+        version (int): incremented each time the configuration changes
+        requests (int): status requests sent
+        not_modified (int): requests answered with 304 Not Modified
+        unchanged (int): 200 responses identical to the previous one
+        changes (int): responses with a new configuration
+    """
+
+    def __init__(self, bb_endpoint, token=None, min_interval=15):
+        if bb_endpoint[-1] != '/':
+            bb_endpoint = bb_endpoint + '/'
+        self.bb_endpoint = bb_endpoint
+        self.token = token
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.lane_status = None
+        self.lane_df = None
+        self.version = 0
+        self.checked = None
+        self.validators = {}
+        self.digest = None
+        self.requests = 0
+        self.not_modified = 0
+        self.unchanged = 0
+        self.changes = 0
+
+    def poll(self):
+        """
+        Requests the status and updates the configuration if it changed
+
+        Returns:
+            bool: True if the configuration changed
+        """
+        headers = {}
+        if 'ETag' in self.validators:
+            headers['If-None-Match'] = self.validators['ETag']
+        if 'Last-Modified' in self.validators:
+            headers['If-Modified-Since'] = self.validators['Last-Modified']
+
+        with METRICS.timer('status_request'):
+            response = http_get(f'{self.bb_endpoint}?token={self.token}', headers=headers)
+        self.requests += 1
+        self.checked = time.monotonic()
+        if response.status_code == 304:
+            self.not_modified += 1
+            return False
+
+        self.validators = {k: response.headers[k] for k in ['ETag', 'Last-Modified']
+                           if k in response.headers}
+        digest = hashlib.blake2b(response.content, digest_size=16).digest()
+        if digest == self.digest:
+            self.unchanged += 1
+            return False
+        self.digest = digest
+
+        lane_status = parse_lane_status(loads(response.content))
+        archive_status(lane_status)
+        if lane_status == self.lane_status:
+            self.unchanged += 1
+            return False
+
+        self.lane_status = lane_status
+        self.lane_df = lane_status_df(lane_status)
+        self.version += 1
+        self.changes += 1
+        return True
+
+    def get(self):
+        """
+        Returns the current configuration, polling the endpoint if the last
+        check is older than min_interval
+
+        Returns:
+            tuple: (lane_status, lane_df), lane_df in the
+                   get_bb_current_status_df format. Its measurement_tstamp is
+                   the time of the last change, not of the last check.
+        """
+        with self.lock:
+            if (self.lane_status is None or self.min_interval <= 0
+                    or time.monotonic() - self.checked >= self.min_interval):
+                self.poll()
+            return self.lane_status, self.lane_df
+
+    def stats(self):
+        """
+        Returns:
+            dict: configuration version, requests, not_modified, unchanged
+                  and changes counters
+        """
+        return {
+            'version': self.version,
+            'requests': self.requests,
+            'not_modified': self.not_modified,
+            'unchanged': self.unchanged,
+            'changes': self.changes,
+        }
@@ -0,0 +1,155 @@
+# Local stub of the baybridge speed and status endpoints, serving recorded
+# data. Used to run the models, the HTTP client and benchmarks offline.
+# Usage: python stubserver.py --speed SPEEDS.csv --status STATUS.json [--port 8080]
+# Then: python main.py -s http://localhost:8080/speed/recent/ -b http://localhost:8080/status/
+# Functions:
+# - make_stub_server: Creates the stub HTTP server
+
+import argparse
+import gzip
+import hashlib
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pandas as pd
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, body, content_type, status=200, headers=None):
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            encoding = 'gzip'
+        else:
+            encoding = None
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            failing = server.requests <= server.fail_first
+
+        if server.delay > 0:
+            time.sleep(server.delay)
+        if failing:
+            self.send_body(b'stub failure', 'text/plain', status=503)
+            return
+
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.rstrip('/') == '/speed/recent':
+            self.send_body(server.speed_csv(query), 'text/csv')
+        elif url.path.rstrip('/') == '/status':
+            etag = server.status_etag()
+            if server.etag and self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_body(server.status, 'application/json',
+                           headers={'ETag': etag} if server.etag else None)
+        else:
+            self.send_body(b'not found', 'text/plain', status=404)
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, speeds, status, window=60,
+                 delay=0, fail_first=0, verbose=False, filter_tmcs=True,
+                 etag=True):
+        super().__init__(address, StubHandler)
+        self.speeds = speeds
+        self.tstamps = pd.to_datetime(speeds['measurement_tstamp'], utc=True)
+        self.status = status
+        self.window = pd.Timedelta(minutes=window)
+        self.delay = delay
+        self.fail_first = fail_first
+        self.verbose = verbose
+        self.filter_tmcs = filter_tmcs
+        self.etag = etag
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def status_etag(self):
+        # The status can be replaced while serving, to simulate changes
+        return '"' + hashlib.md5(self.status).hexdigest() + '"'
+
+    def speed_csv(self, query):
+        """
+        Returns recorded speeds of the requested tmcs, for the window ending
+        at asOf (or at the last recorded timestamp)
+        """
+        if 'asOf' in query:
+            asof = pd.Timestamp(query['asOf'][0].rstrip('Z'), tz='UTC')
+        else:
+            asof = self.tstamps.max()
+        mask = (self.tstamps <= asof) & (self.tstamps > asof - self.window)
+        if 'tmcs' in query and self.filter_tmcs:
+            mask &= self.speeds['tmc_code'].isin(query['tmcs'][0].split(','))
+        return self.speeds[mask].to_csv(index=False).encode()
+
+
+def make_stub_server(speed_file, status_file, host='127.0.0.1', port=8080,
+                     **kwargs):
+    """
+    Creates the stub HTTP server (call serve_forever() to run it)
+
+    Args:
+        speed_file (str): csv file with recorded speed endpoint rows
+        status_file (str): json file with a recorded status endpoint response
+        host (str): interface to listen on
+        port (int): port to listen on. 0 picks a free port.
+        kwargs: window (speed window [min]), delay (response delay [s]),
+                fail_first (number of first requests answered with 503),
+                verbose (log requests), filter_tmcs (if False, all
+                recorded tmcs are served whatever the requested tmcs), etag
+                (if False, the status has no ETag and is never answered
+                with 304)
+
+    Returns:
+        StubServer: server
+    """
+    speeds = pd.read_csv(speed_file, dtype=str)
+    with open(status_file, 'rb') as f:
+        status = f.read()
+    return StubServer((host, port), speeds, status, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stub of the baybridge endpoints')
+    parser.add_argument('--speed', required=True, help='Recorded speeds (csv)')
+    parser.add_argument('--status', required=True, help='Recorded status (json)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--window', type=int, default=60,
+                        help='Length of the served speed window [min]')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='Delay of each response [s]')
+    parser.add_argument('--fail-first', type=int, default=0,
+                        help='Number of first requests answered with 503')
+    args = parser.parse_args()
+
+    server = make_stub_server(args.speed, args.status,
+                              host=args.host, port=args.port,
+                              window=args.window, delay=args.delay,
+                              fail_first=args.fail_first, verbose=True)
+    print(f'Serving on http://{args.host}:{server.server_address[1]}/')
+    server.serve_forever()
@@ -0,0 +1,44 @@
+# The app modules are imported by bare name (python is run from app/)
+import os
+import sys
+import threading
+
+import pytest
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if APP_PATH not in sys.path:
+    sys.path.insert(0, APP_PATH)
+
+
+@pytest.fixture
+def app_dir(monkeypatch):
+    """
+    Runs the test from the app folder, where config.yaml, data/ and models/
+    are read from
+    """
+    monkeypatch.chdir(APP_PATH)
+    return APP_PATH
+
+
+@pytest.fixture
+def stub_server():
+    """
+    Returns a function starting a StubServer on a free port, with the
+    arguments of StubServer (speeds, status, window, delay, fail_first...).
+    The servers are stopped after the test.
+    """
+    from stubserver import StubServer
+
+    servers = []
+
+    def start(speeds, status, **kwargs):
+        server = StubServer(('127.0.0.1', 0), speeds, status, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        server.url = f'http://127.0.0.1:{server.server_address[1]}'
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,53 @@
+# Short backtest against the local stub: every replayed timestamp is
+# estimated for all lane configurations, from the speeds up to itself
+
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+pytest.importorskip('xgboost')
+
+from backtest import backtest_timestamps, run_backtest
+from benchmark import status_payload, synthetic_payload
+from getrawdata import read_all_tmcs, read_target_tmcs
+from processdata import LANE_CONFIGURATIONS
+
+
+# Speeds from 05:31 to 07:00, so 06:30 is the first timestamp with all lags
+LAST = datetime(2022, 10, 5, 7, 0, tzinfo=timezone.utc)
+
+
+def test_backtest_rows_and_asof(app_dir, stub_server, tmp_path):
+    tmcs = read_all_tmcs('./data/')['East']
+    speeds = pd.read_csv(io.BytesIO(synthetic_payload(tmcs, 90, LAST)), dtype=str)
+    server = stub_server(speeds, status_payload(), window=24 * 60)
+
+    timestamps = backtest_timestamps('2022-10-05T06:30', '2022-10-05T07:00')
+    output = str(tmp_path / 'backtest.parquet')
+    stats = run_backtest(timestamps, output, directions=['East'],
+                         speed_endpoint=f'{server.url}/speed/recent/',
+                         token='x', chunk=3)
+
+    # 7 timestamps in chunks of 3, one speed request per chunk
+    assert stats['timestamps'] == 7 and stats['chunks'] == 3
+    assert stats['estimated'] == 7
+    assert server.requests == 3
+
+    df = pd.read_parquet(output)
+    n_target = len(read_target_tmcs('./data/')['East'])
+    assert len(df) == stats['rows'] == 7 * n_target * len(LANE_CONFIGURATIONS)
+    assert (df['direction'] == 'East').all()
+    assert [f'sr_pred_{x}' for x in range(5, 31, 5)] == \
+        [x for x in df.columns if x.startswith('sr_pred_')]
+
+    asof = pd.to_datetime(df['asof'], utc=True)
+    assert sorted(asof.unique()) == list(timestamps)
+    assert (asof.value_counts() == n_target * len(LANE_CONFIGURATIONS)).all()
+    # Each timestamp is estimated from its own (latest) 5 minute interval
+    assert (pd.to_datetime(df['measurement_tstamp'], utc=True) == asof).all()
+    for _, rows in df.groupby(asof):
+        configurations = rows[['East', 'West']].drop_duplicates()
+        assert len(configurations) == len(LANE_CONFIGURATIONS)
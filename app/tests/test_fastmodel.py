@@ -0,0 +1,42 @@
+# FastPipeline parity with the pickled Pipelines, on fixed ML data in the
+# input columns of each direction (tests/data/ml_data_{direction}.csv).
+# Rows 12 to 23 have missing values, so the imputer medians are exercised.
+
+import os
+
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+joblib = pytest.importorskip('joblib')
+pytest.importorskip('sklearn')
+pytest.importorskip('xgboost')
+
+from fastmodel import check_parity, export_fast_pipeline
+from modelbundle import model_keys
+
+
+APP_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_PATH = os.path.join(APP_PATH, 'models')
+DATA_PATH = os.path.join(APP_PATH, 'tests', 'data')
+CALENDAR = ['season', 'month', 'dow', 'hour']
+
+
+def read_ml_data(direction):
+    ml_data = pd.read_csv(os.path.join(DATA_PATH, f'ml_data_{direction}.csv'))
+    ml_data['tmc_code'] = ml_data['tmc_code'].astype('category')
+    ml_data['measurement_tstamp'] = pd.to_datetime(ml_data['measurement_tstamp'], utc=True)
+    ml_data[CALENDAR] = ml_data[CALENDAR].astype(np.int8)
+    return ml_data
+
+
+@pytest.mark.parametrize('key', list(model_keys()))
+def test_fast_pipeline_parity(key):
+    pipeline = joblib.load(os.path.join(MODEL_PATH, model_keys()[key]))
+    ml_data = read_ml_data(key.rstrip('0123456789'))
+    assert ml_data.iloc[12:].isna().any(axis=None)
+
+    fast_pipeline = export_fast_pipeline(pipeline)
+    np.testing.assert_allclose(fast_pipeline.predict(ml_data),
+                               pipeline.predict(ml_data), rtol=1e-5, atol=1e-5)
+    assert check_parity(pipeline, fast_pipeline, ml_data) < 1e-4
@@ -0,0 +1,85 @@
+# Shared HTTP client (configure_http, http_get) against the local stub:
+# retries of 503 responses, read timeouts, gzip responses and status pulls
+
+import io
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+requests = pytest.importorskip('requests')
+pytest.importorskip('pyarrow')
+
+import getrawdata
+from benchmark import status_payload, synthetic_payload
+from getrawdata import configure_http, get_bb_data, get_speed_data, http_get
+
+
+TMCS = ['110+04349', '110+04350', '110+04351']
+ASOF = datetime(2022, 10, 5, 6, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(autouse=True)
+def http_settings():
+    # Each test configures the client; the defaults are restored after it
+    settings = dict(getrawdata.HTTP_SETTINGS)
+    yield
+    configure_http(**settings)
+
+
+@pytest.fixture
+def speeds():
+    return pd.read_csv(io.BytesIO(synthetic_payload(TMCS, 60, ASOF)), dtype=str)
+
+
+def test_retries_503_until_success(stub_server, speeds):
+    server = stub_server(speeds, status_payload(), fail_first=2)
+    configure_http(retries=3, backoff_factor=0)
+
+    response = http_get(f'{server.url}/status/')
+    assert response.status_code == 200
+    assert response.content == status_payload()
+    assert server.requests == 3
+
+
+def test_503_after_retries_raises(stub_server, speeds):
+    server = stub_server(speeds, status_payload(), fail_first=5)
+    configure_http(retries=2, backoff_factor=0)
+
+    with pytest.raises(requests.HTTPError):
+        http_get(f'{server.url}/status/')
+    assert server.requests == 3
+
+
+def test_read_timeout_is_retried_then_raises(stub_server, speeds):
+    server = stub_server(speeds, status_payload(), delay=1)
+    configure_http(read_timeout=0.2, retries=1, backoff_factor=0)
+
+    start = time.perf_counter()
+    with pytest.raises(requests.RequestException):
+        http_get(f'{server.url}/status/')
+    assert time.perf_counter() - start < 1
+    assert server.requests == 2
+
+
+def test_gzip_responses_are_decoded(stub_server, speeds):
+    server = stub_server(speeds, status_payload())
+
+    response = http_get(f'{server.url}/status/')
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert response.content == status_payload()
+
+    # get_speed_data decodes the raw stream itself
+    df = get_speed_data(TMCS, speed_endpoint=f'{server.url}/speed/recent/',
+                        asof=ASOF, token='x')
+    assert len(df) == len(speeds)
+    assert sorted(df['tmc_code'].astype(str).unique()) == TMCS
+
+
+def test_status_is_not_parsed_without_archive(stub_server, speeds, monkeypatch):
+    server = stub_server(speeds, status_payload())
+    monkeypatch.setitem(getrawdata._archive, 'archive', None)
+    monkeypatch.setattr(getrawdata, 'parse_lane_status', None)
+
+    assert get_bb_data(f'{server.url}/status/', token='x')
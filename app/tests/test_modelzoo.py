@@ -0,0 +1,66 @@
+# ModelZoo estimates against the local stub
+
+import io
+from datetime import datetime, timezone
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+pytest.importorskip('xgboost')
+
+from benchmark import status_payload, synthetic_payload
+from getrawdata import read_all_tmcs, read_target_tmcs
+from processdata import LANE_CONFIGURATIONS
+
+
+LAST = datetime(2022, 10, 5, 9, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def modelzoo(app_dir, stub_server):
+    from modelzoo import ModelZoo
+
+    # 5 hours of speeds served through a 60 minute window
+    tmcs = read_all_tmcs('./data/')['East']
+    speeds = pd.read_csv(io.BytesIO(synthetic_payload(tmcs, 300, LAST)), dtype=str)
+    server = stub_server(speeds, status_payload(), window=60)
+    modelzoo = ModelZoo(speed_endpoint=f'{server.url}/speed/recent/', token='x')
+    modelzoo.server = server
+    return modelzoo
+
+
+def test_estimate_batch_longer_than_the_endpoint_window(modelzoo):
+    assert modelzoo.ARCHIVE_PATH is None and modelzoo.SPEED_WINDOW == 60
+    # 3 hours of instants: with their lags, 05:30 to 09:00
+    asofs = pd.date_range('2022-10-05 06:00', LAST, freq='5min', tz='UTC')
+
+    res_df = modelzoo.estimate_batch('East', list(asofs))
+
+    # Requests as of 09:00, 08:00, 07:00 and 06:00
+    assert modelzoo.server.requests == 4
+    n_target = len(read_target_tmcs('./data/')['East'])
+    counts = res_df.groupby('asof').size()
+    assert list(counts.index) == list(asofs)
+    assert (counts == n_target * len(LANE_CONFIGURATIONS)).all()
+    assert not res_df['sr_pred_5'].isna().any()
+
+
+def test_estimate_batch_requests_only_needed_windows(modelzoo):
+    asofs = [datetime(2022, 10, 5, 6, 0, tzinfo=timezone.utc), LAST]
+
+    res_df = modelzoo.estimate_batch('East', asofs)
+
+    # One request per instant, none for the 3 hours between them
+    assert modelzoo.server.requests == 2
+    assert sorted(res_df['asof'].unique()) == list(pd.DatetimeIndex(asofs))
+
+
+def test_json_header_flags_only_stale_estimates(modelzoo):
+    fresh = modelzoo.get_json_header_dic('East', 'all')
+    assert list(fresh) == ['timestamp', 'input_parameters', 'measurement_tstamp', 'version']
+
+    stale = modelzoo.get_json_header_dic('East', 'all', stale=True)
+    assert stale['stale'] is True
+    assert list(stale) == ['timestamp', 'input_parameters', 'measurement_tstamp',
+                           'stale', 'version']
@@ -0,0 +1,86 @@
+# Features and queues of processdata against the original merge-based
+# implementations (reference_processdata.py), on the 5 minute East speeds of
+# tests/data/speeds_East.csv: all tmcs at every timestamp, with two queues
+# that grow and shrink over two hours
+
+import os
+
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+import reference_processdata as reference
+from getrawdata import read_all_tmcs, read_target_tmcs
+from processdata import generate_queue_data, iter_queue_data, prepare_ml_data
+
+
+DATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+
+@pytest.fixture
+def inputs(app_dir):
+    speeds = pd.read_csv(os.path.join(DATA_PATH, 'speeds_East.csv'))
+    speeds['measurement_tstamp'] = pd.to_datetime(speeds['measurement_tstamp'], utc=True)
+    times = speeds['measurement_tstamp'].drop_duplicates().reset_index(drop=True)
+    # The lanes change at 07:00
+    west = np.where(times.dt.hour < 7, 2, 3)
+    lane_data = pd.DataFrame({'measurement_tstamp': times, 'West': west, 'East': 5 - west})
+    return (read_all_tmcs('./data/')['East'], read_target_tmcs('./data/')['East'],
+            speeds, lane_data)
+
+
+def test_generate_queue_data_matches_reference(inputs):
+    _, tmc_target, speeds, _ = inputs
+
+    expected = reference.generate_queue_data(speeds.copy(), tmc_target).reset_index(drop=True)
+    actual = generate_queue_data(speeds, tmc_target).reset_index(drop=True)
+
+    assert set(actual['num_queue']) == {'zero', 'one', 'more_than_one'}
+    actual['num_queue'] = actual['num_queue'].astype(str)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, check_exact=True)
+
+
+def test_iter_queue_data_matches_whole_window(inputs):
+    _, tmc_target, speeds, _ = inputs
+    # Uneven chunks, some shorter than the 30 minutes of lags
+    bounds = pd.to_datetime(['2022-10-05 06:20', '2022-10-05 06:35',
+                             '2022-10-05 07:20'], utc=True)
+    chunk_ids = bounds.searchsorted(speeds['measurement_tstamp'], side='right')
+    chunks = [x for _, x in speeds.groupby(chunk_ids)]
+    assert len(chunks) == 4
+
+    expected = generate_queue_data(speeds, tmc_target).reset_index(drop=True)
+    actual = pd.concat(list(iter_queue_data(chunks, tmc_target)), ignore_index=True)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=True)
+
+
+def test_prepare_ml_data_matches_reference(inputs):
+    tmc_list, tmc_target, speeds, lane_data = inputs
+    queue_data = generate_queue_data(speeds, tmc_target)
+
+    expected = reference.prepare_ml_data(tmc_list, tmc_target, speeds.copy(),
+                                         lane_data.copy(), queue_data)
+    actual = prepare_ml_data(tmc_list, tmc_target, speeds, lane_data, queue_data)
+
+    assert list(actual.columns) == list(expected.columns)
+    # Lags before the first timestamp are missing, as in the reference
+    assert actual['sr_30'].isna().any()
+    # Only dtypes may differ (categorical tmc codes, int8 calendar fields)
+    actual['tmc_code'] = actual['tmc_code'].astype(str)
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False, check_exact=True)
+
+
+def test_prepare_ml_data_for_timestamps(inputs):
+    tmc_list, tmc_target, speeds, lane_data = inputs
+    queue_data = generate_queue_data(speeds, tmc_target)
+    timestamps = list(speeds['measurement_tstamp'].drop_duplicates().iloc[[0, 10, -1]])
+
+    whole = prepare_ml_data(tmc_list, tmc_target, speeds, lane_data, queue_data)
+    expected = whole[whole['measurement_tstamp'].isin(timestamps)].reset_index(drop=True)
+    actual = prepare_ml_data(tmc_list, tmc_target, speeds, lane_data, queue_data,
+                             timestamps=timestamps)
+
+    expected['tmc_code'] = expected['tmc_code'].astype(str)
+    actual['tmc_code'] = actual['tmc_code'].astype(str)
+    pd.testing.assert_frame_equal(actual, expected, check_exact=True)
@@ -0,0 +1,41 @@
+# Overlapping speed pulls are archived once
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+
+from speedarchive import SpeedArchive
+
+
+def speeds(start, minutes, tmcs=('110+04349', '110+04350')):
+    tstamps = pd.date_range(start, periods=minutes, freq='1min', tz='UTC')
+    df = pd.DataFrame([(tmc, t) for t in tstamps for tmc in tmcs],
+                      columns=['tmc_code', 'measurement_tstamp'])
+    df['speed'] = df['average_speed'] = 50
+    df['reference_speed'] = 60
+    df['travel_time_minutes'] = 0.5
+    return df
+
+
+def archived_rows(archive, start, end):
+    files = archive._files('speed', pd.Timestamp(start), pd.Timestamp(end))
+    return sum(pd.read_parquet(x).shape[0] for x in files)
+
+
+def test_overlapping_pulls_write_new_records(tmp_path):
+    archive = SpeedArchive(str(tmp_path))
+    archive.write_speeds(speeds('2022-10-05 06:00', 60))
+    archive.write_speeds(speeds('2022-10-05 06:05', 60))
+    archive.write_speeds(speeds('2022-10-05 06:05', 60))
+
+    assert archived_rows(archive, '2022-10-05', '2022-10-05') == 2 * 65
+    df = archive.read_speeds('2022-10-05 06:00', '2022-10-05 07:04')
+    assert len(df) == 2 * 65
+
+
+def test_new_archive_instance_reads_last_timestamps(tmp_path):
+    SpeedArchive(str(tmp_path)).write_speeds(speeds('2022-10-05 06:00', 60))
+    SpeedArchive(str(tmp_path)).write_speeds(speeds('2022-10-05 06:30', 60, tmcs=('110+04349',)))
+
+    assert archived_rows(SpeedArchive(str(tmp_path)), '2022-10-05', '2022-10-05') == 2 * 60 + 30
@@ -0,0 +1,49 @@
+# Rolling speed state: incremental updates give the window a rebuild would
+
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from speedstate import SpeedState
+
+
+TMCS = ['110+04349', '110+04350']
+
+
+def pull(start, end, skip=()):
+    """
+    Speed pull with one record per tmc and minute from start to end
+    (included), without the (tmc, 5 minute interval) pairs of skip
+    """
+    rows = []
+    for t in pd.date_range(start, end, freq='1min', tz='UTC'):
+        for i, tmc in enumerate(TMCS):
+            if (tmc, t.floor('5min')) in skip:
+                continue
+            speed = 20 + i * 30 + t.minute % 30
+            rows.append((tmc, t.strftime('%Y-%m-%d %H:%M:%S'), speed, speed, 60, 60 / speed))
+    df = pd.DataFrame(rows, columns=['tmc_code', 'measurement_tstamp', 'speed',
+                                     'average_speed', 'reference_speed',
+                                     'travel_time_minutes'])
+    df['tmc_code'] = df['tmc_code'].astype('category')
+    return df
+
+
+def test_pull_longer_than_window_leaves_no_stale_slot():
+    state = SpeedState(TMCS)
+    state.update(pull('2022-10-05 06:00', '2022-10-05 06:30'))
+
+    # Covers 06:00 to 07:14 (15 intervals). The second tmc has no reading
+    # at 07:10, whose slot is the one of 06:35
+    last = pd.Timestamp('2022-10-05 07:10', tz='UTC')
+    raw = pull('2022-10-05 06:00', '2022-10-05 07:14', skip={(TMCS[1], last)})
+    speeds = state.update(raw)
+    assert state.increments == 1
+
+    expected = SpeedState(TMCS).update(raw)
+    pd.testing.assert_frame_equal(speeds, expected)
+    assert speeds['measurement_tstamp'].min() == last - pd.Timedelta(minutes=30)
+    at_last = speeds[speeds['measurement_tstamp'] == last]
+    assert list(at_last['tmc_code'].astype(str)) == [TMCS[0]]
+    assert not np.isnan(speeds['speed']).any()
@@ -0,0 +1,335 @@
+# Trains the direction/horizon models from the local speed archive
+# (speedarchive.py), out of core. Speeds and lane statuses are read one time
+# chunk at a time, with 30 minutes before the chunk for the lags and 30
+# minutes after it for the targets, and the features are built with the
+# processdata functions used at inference. Feature chunks are cached on disk
+# and the boosters are trained with xgboost external memory, so the memory
+# used does not depend on the length of the history.
+# Usage: python train.py --archive ARCHIVE --start 2022-07-01 --end 2022-10-01
+#        [--direction both] [--output ./models/] [--chunk-days 1]
+# Functions:
+# - read_inputs: Reads the model input columns of a direction
+# - lane_data_for: Produces 5 minute lane data from archived statuses
+# - iter_training_chunks: Yields features and targets, one time chunk at a time
+# - build_preprocessor: Fits the preprocessing of the pickled models
+# - build_pipeline: Builds a Pipeline in the format of the pickled models
+# - train_direction: Trains and saves the models of one direction
+
+import argparse
+import os
+import tempfile
+from datetime import timedelta
+
+import joblib
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from getrawdata import (agg_speed_5m, get_bb_base_status_df, read_all_tmcs,
+                        read_target_tmcs)
+from modelbundle import model_keys
+from processdata import LAGS, generate_queue_data, prepare_ml_data
+from speedarchive import SpeedArchive
+
+
+HORIZONS = [5, 10, 15, 20, 25, 30]
+# One-hot encoded columns, in the order of the encoder of the pickled models
+CATEGORIES = {'month': list(range(1, 13)), 'dow': list(range(7)), 'hour': list(range(24))}
+XGB_PARAMS = {
+    'objective': 'reg:squarederror',
+    'tree_method': 'hist',
+    'max_depth': 6,
+    'eta': 0.1,
+}
+
+
+def read_inputs(direction, data_path='./data/'):
+    """
+    Reads the model input columns of a direction (inputs_{direction}.txt).
+    The categorical columns are always all of CATEGORIES (month, dow, hour),
+    as encoded by the pickled models, whether or not the file lists them.
+
+    Returns:
+        (list, list): numeric and categorical input columns
+    """
+    with open(os.path.join(data_path, f'inputs_{direction}.txt')) as f:
+        columns = [x.strip() for x in f.read().split(',') if x.strip()]
+    return [x for x in columns if x not in CATEGORIES], list(CATEGORIES)
+
+
+def lane_data_for(status, intervals):
+    """
+    Produces lane data for 5 minute intervals from archived statuses. Each
+    interval gets the latest status pulled before its end; intervals before
+    the first archived status get the base status (2W, 3E).
+
+    Args:
+        status (pd.DataFrame): statuses, as returned by SpeedArchive.read_status
+        intervals (pd.DatetimeIndex): UTC 5 minute intervals
+
+    Returns:
+        pd.DataFrame: lane data (measurement_tstamp, West, East), as used by
+                      prepare_ml_data
+    """
+    lane_data = pd.DataFrame({'measurement_tstamp': intervals})
+    base = get_bb_base_status_df()
+    if len(status) == 0:
+        lane_data['West'], lane_data['East'] = base.West[0], base.East[0]
+        return lane_data
+
+    status = status[['measurement_tstamp', 'West', 'East']].rename(
+        columns={'measurement_tstamp': 'pulled_at'})
+    lane_data['end'] = lane_data['measurement_tstamp'] + timedelta(minutes=5)
+    lane_data = pd.merge_asof(lane_data, status, left_on='end', right_on='pulled_at',
+                              direction='backward', allow_exact_matches=False)
+    lane_data['West'] = lane_data['West'].fillna(base.West[0]).astype('int64')
+    lane_data['East'] = lane_data['East'].fillna(base.East[0]).astype('int64')
+    return lane_data[['measurement_tstamp', 'West', 'East']]
+
+
+def _targets(speeds, ml_data):
+    # sr of the same tmc, horizon minutes later
+    sr = pd.Series((speeds['speed'] / speeds['reference_speed']).to_numpy(),
+                   index=pd.MultiIndex.from_arrays([speeds['tmc_code'].astype(str),
+                                                    speeds['measurement_tstamp']]))
+    tmcs = ml_data['tmc_code'].astype(str)
+    return np.column_stack([
+        sr.reindex(pd.MultiIndex.from_arrays([
+            tmcs, ml_data['measurement_tstamp'] + timedelta(minutes=horizon)])).to_numpy()
+        for horizon in HORIZONS
+    ])
+
+
+def iter_training_chunks(archive, direction, start, end, chunk_days=1,
+                         data_path='./data/'):
+    """
+    Yields features and targets, one time chunk at a time. Each chunk reads
+    the archived speeds from 30 minutes before it (lags) to 30 minutes after
+    it (targets), so only one chunk of speeds is in memory.
+
+    Args:
+        archive (SpeedArchive): archive with speeds and statuses
+        direction (string): Traffic direction (East/West)
+        start (datetime): first timestamp (UTC)
+        end (datetime): end of the history (UTC, excluded)
+        chunk_days (int): length of a chunk [days]
+        data_path (str): path to the data folder
+
+    Yields:
+        (pd.DataFrame, np.ndarray): ML data, as returned by prepare_ml_data,
+            and targets (sr 5-30 minutes later, one column per horizon,
+            NaN where missing)
+    """
+    tmc_list = read_all_tmcs(data_path)[direction]
+    tmc_target = read_target_tmcs(data_path)[direction]
+    span = timedelta(minutes=max(LAGS))
+    start, end = pd.Timestamp(start, tz='UTC'), pd.Timestamp(end, tz='UTC')
+
+    chunk_start = start
+    while chunk_start < end:
+        chunk_end = min(chunk_start + timedelta(days=chunk_days), end)
+        raw = archive.read_speeds(chunk_start - span,
+                                  chunk_end + span - timedelta(seconds=1), tmc_list)
+        if len(raw) > 0:
+            speeds = agg_speed_5m(raw)
+            intervals = pd.date_range(chunk_start - span, chunk_end + span,
+                                      freq='5min', inclusive='left')
+            status = archive.read_status(chunk_start - timedelta(days=1), chunk_end)
+            timestamps = [x for x in speeds.measurement_tstamp.unique()
+                          if chunk_start <= x < chunk_end]
+
+            queue_data = generate_queue_data(speeds, tmc_target, timestamps=timestamps)
+            ml_data = prepare_ml_data(
+                tmc_list=tmc_list,
+                tmc_target=tmc_target,
+                speeds=speeds,
+                lane_data=lane_data_for(status, intervals),
+                queue_data=queue_data,
+                timestamps=timestamps,
+                dtype=np.float32)
+            if len(ml_data) > 0:
+                yield ml_data, _targets(speeds, ml_data)
+        chunk_start = chunk_end
+
+
+class _ChunkIter(xgb.DataIter):
+    # Feeds the cached chunks of one horizon to xgboost external memory
+    def __init__(self, files, horizon_idx, cache_prefix):
+        self.files = files
+        self.horizon_idx = horizon_idx
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        while self.position < len(self.files):
+            X_file, y_file = self.files[self.position]
+            self.position += 1
+            y = np.load(y_file, mmap_mode='r')[:, self.horizon_idx]
+            rows = np.flatnonzero(~np.isnan(y))
+            if len(rows) > 0:
+                input_data(data=np.load(X_file, mmap_mode='r')[rows], label=y[rows])
+                return 1
+        return 0
+
+    def reset(self):
+        self.position = 0
+
+
+def build_preprocessor(num_columns, cat_columns, sample):
+    """
+    Fits the preprocessing of the pickled models (see
+    fastmodel.export_fast_pipeline) on a sample of the features
+
+    Args:
+        num_columns (list): numeric input columns (median imputation and
+                            standard scaling)
+        cat_columns (list): categorical input columns (one-hot encoding)
+        sample (pd.DataFrame): features the preprocessing is fitted on
+
+    Returns:
+        ColumnTransformer: fitted preprocessor
+    """
+    num = Pipeline([
+        ('imputer', SimpleImputer(strategy='median')),
+        ('scaler', StandardScaler()),
+    ])
+    encoder = OneHotEncoder(categories=[CATEGORIES[x] for x in cat_columns],
+                            handle_unknown='ignore')
+    preprocessor = ColumnTransformer([
+        ('num', num, num_columns),
+        ('cat', encoder, cat_columns),
+    ], remainder='drop', sparse_threshold=0)
+    return preprocessor.fit(sample)
+
+
+def build_pipeline(preprocessor, booster):
+    """
+    Builds a Pipeline in the format of the pickled models
+
+    Args:
+        preprocessor (ColumnTransformer): fitted preprocessor
+        booster (xgb.Booster): trained booster
+
+    Returns:
+        sklearn.pipeline.Pipeline: 'preprocessor' and 'model' (XGBRegressor)
+    """
+    model = xgb.XGBRegressor()
+    model.load_model(bytearray(booster.save_raw(raw_format='json')))
+    return Pipeline([('preprocessor', preprocessor), ('model', model)])
+
+
+def train_direction(archive, direction, start, end, output='./models/',
+                    chunk_days=1, sample_size=200_000, num_boost_round=300,
+                    params=None, nthread=-1, data_path='./data/', seed=0):
+    """
+    Trains and saves the models of one direction, one per horizon
+
+    The features are built once: each chunk is stored in a temporary
+    directory and a uniform sample (bottom-k of random keys) is kept for
+    fitting the preprocessor. The cached chunks are then transformed and
+    each horizon is trained from them with xgboost external memory.
+
+    Args:
+        archive (SpeedArchive): archive with speeds and statuses
+        direction (string): Traffic direction (East/West)
+        start (datetime): first timestamp (UTC)
+        end (datetime): end of the history (UTC, excluded)
+        output (str): model directory. Pickles are named as in model_keys,
+                      so that ModelZoo.load_model_dict loads them.
+        chunk_days (int): length of a chunk [days]
+        sample_size (int): number of rows the preprocessor is fitted on
+        num_boost_round (int): number of boosting rounds
+        params (dict, optional): xgboost parameters. XGB_PARAMS if None.
+        nthread (int): xgboost threads. -1 uses all cores.
+        data_path (str): path to the data folder
+        seed (int): random seed of the sample
+
+    Returns:
+        dict: {horizon: number of training rows}
+    """
+    num_columns, cat_columns = read_inputs(direction, data_path)
+    columns = num_columns + cat_columns
+    params = dict(XGB_PARAMS if params is None else params, nthread=nthread)
+    rng = np.random.default_rng(seed)
+    keys = model_keys()
+
+    with tempfile.TemporaryDirectory() as work:
+        # Pass 1 - features and targets, cached per chunk, and the sample
+        raw_files, sample, sample_keys = [], None, None
+        for i, (ml_data, targets) in enumerate(iter_training_chunks(
+                archive, direction, start, end, chunk_days, data_path)):
+            features = ml_data.reindex(columns=columns)
+            features_file = os.path.join(work, f'features_{i}.pkl')
+            targets_file = os.path.join(work, f'y_{i}.npy')
+            features.to_pickle(features_file)
+            np.save(targets_file, targets)
+            raw_files.append((features_file, targets_file))
+
+            chunk_keys = rng.random(len(features))
+            if sample is not None:
+                features = pd.concat([sample, features], ignore_index=True)
+                chunk_keys = np.concatenate([sample_keys, chunk_keys])
+            keep = np.argsort(chunk_keys, kind='stable')[:sample_size]
+            sample, sample_keys = features.iloc[keep].reset_index(drop=True), chunk_keys[keep]
+
+        if sample is None:
+            raise ValueError(f'No archived {direction} speeds between {start} and {end}')
+        # All horizons share the preprocessor, so ModelZoo transforms once
+        preprocessor = build_preprocessor(num_columns, cat_columns, sample)
+
+        # Pass 2 - transformed chunks, shared by all horizons
+        files = []
+        for i, (features_file, targets_file) in enumerate(raw_files):
+            X_file = os.path.join(work, f'X_{i}.npy')
+            np.save(X_file, preprocessor.transform(pd.read_pickle(features_file)).astype(np.float32))
+            os.remove(features_file)
+            files.append((X_file, targets_file))
+
+        # Pass 3 - one booster per horizon, from external memory
+        rows = {}
+        for j, horizon in enumerate(HORIZONS):
+            it = _ChunkIter(files, j, os.path.join(work, f'cache_{horizon}'))
+            dtrain = xgb.DMatrix(it, missing=np.nan, nthread=nthread)
+            rows[horizon] = dtrain.num_row()
+            booster = xgb.train(params, dtrain, num_boost_round=num_boost_round)
+            del dtrain
+
+            pipeline = build_pipeline(preprocessor, booster)
+            os.makedirs(output, exist_ok=True)
+            joblib.dump(pipeline, os.path.join(output, keys[f'{direction}{horizon}']))
+
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the models from the speed archive')
+    parser.add_argument('--archive', required=True, help='Speed archive (see speedarchive.py)')
+    parser.add_argument('--start', required=True, help='First timestamp (UTC)')
+    parser.add_argument('--end', required=True, help='End of the history (UTC, excluded)')
+    parser.add_argument('--direction', default='both', choices=['East', 'West', 'both'])
+    parser.add_argument('--output', default='./models/', help='Model directory')
+    parser.add_argument('--chunk-days', type=int, default=1,
+                        help='Length of a chunk of history [days]')
+    parser.add_argument('--sample', type=int, default=200_000,
+                        help='Number of rows the preprocessing is fitted on')
+    parser.add_argument('--rounds', type=int, default=300,
+                        help='Number of boosting rounds')
+    parser.add_argument('--threads', type=int, default=-1,
+                        help='xgboost threads. -1 uses all cores.')
+    args = parser.parse_args()
+
+    archive = SpeedArchive(args.archive)
+    directions = ['East', 'West'] if args.direction == 'both' else [args.direction]
+    for direction in directions:
+        rows = train_direction(archive, direction, args.start, args.end,
+                               output=args.output,
+                               chunk_days=args.chunk_days,
+                               sample_size=args.sample,
+                               num_boost_round=args.rounds,
+                               nthread=args.threads)
+        for horizon, n_rows in rows.items():
+            print(f'{direction}{horizon}: trained on {n_rows} rows')